@@ -0,0 +1,69 @@
+"""
+Measures the import time and the resident memory the plugin adds to a pretix process.
+
+Every measure runs in a fresh interpreter, where pretix is set up with the plugin's ready() disabled; then the modules
+loaded at startup (pretix_xpay.signals) and the ones loaded on first use (the payment provider and the XPay api) are imported.
+Run it in an environment where pretix is configured:
+
+    DJANGO_SETTINGS_MODULE=pretix.settings python benchmarks/bench_import.py [--runs 5]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = r"""
+import json, os, resource, sys, time
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+import django
+import pretix_xpay.apps
+pretix_xpay.apps.PluginApp.ready = lambda self: None
+django.setup()
+
+result = {}
+for stage, modules in (("startup", ["pretix_xpay.signals"]), ("first_use", ["pretix_xpay.payment", "pretix_xpay.xpay_api", "requests"])):
+    before_modules = set(sys.modules)
+    before_rss = rss_kb()
+    start = time.perf_counter()
+    for module in modules:
+        __import__(module)
+    result[stage] = {
+        "time_ms": (time.perf_counter() - start) * 1000,
+        "rss_kb": rss_kb() - before_rss,
+        "new_modules": sorted(set(sys.modules) - before_modules),
+    }
+print(json.dumps(result))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--verbose", action="store_true", help="List the modules loaded by every stage")
+    args = parser.parse_args()
+
+    runs = []
+    for i in range(args.runs):
+        output = subprocess.run([sys.executable, "-c", CHILD], capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    for stage in ("startup", "first_use"):
+        times = [r[stage]["time_ms"] for r in runs]
+        rss = [r[stage]["rss_kb"] for r in runs]
+        modules = runs[-1][stage]["new_modules"]
+        print(f"{stage}: {statistics.median(times):.1f} ms (min {min(times):.1f}), {statistics.median(rss):.0f} KiB RSS, {len(modules)} new modules")
+        if args.verbose:
+            for module in modules:
+                print(f"    {module}")
+
+
+if __name__ == "__main__":
+    main()
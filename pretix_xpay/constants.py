@@ -10,6 +10,10 @@ DOCS_TEST_CARDS_URL = "https://ecommerce.nexi.it/area-test"
 
 HASH_TAG = "plugins:pretix_xpay"
 
+SETTLED_MARKER_TIMEOUT = 60 * 60 * 24 # Seconds a settled payment marker is kept in cache to answer duplicate returns
+REDIRECT_PARAMS_TIMEOUT = 60 * 15 # Seconds the signed redirect parameters of a payment are kept in cache
+QUOTA_AVAILABILITY_TIMEOUT = 5 # Seconds a quota availability is kept in cache by the quota pre-check
+
 XPAY_STATUS_SUCCESS = ["OK"]
 XPAY_STATUS_FAILS = ["KO", "ANNULLO", "ERRORE"]
 XPAY_STATUS_PENDING = ["PEN"]
@@ -23,6 +27,35 @@ XPAY_RESULT_CANCELED = ["Autor. Negata", "Non Creato", "Negato", "Annullato", "A
 XPAY_OPERATION_CAPTURE = "CONTAB."
 XPAY_OPERATION_REFUND = "STORNO"
 
+# Outcomes of a preauthorization release
+RELEASE_REFUNDED = "refunded"
+RELEASE_ALREADY_RELEASED = "already_released"
+RELEASE_NOT_FOUND = "not_found"
+RELEASE_CAPTURED = "captured"
+RELEASE_UNKNOWN = "unknown"
+RELEASE_FAILED = "failed"
+RELEASE_SKIPPED = "skipped" # The payment was confirmed or settled in the meantime
+RELEASE_NEEDS_ATTENTION = [RELEASE_CAPTURED, RELEASE_UNKNOWN, RELEASE_FAILED]
+RELEASED_INFO_KEY = "xpay_released" # Set in the info of a payment whose preauthorization is being released: it must never be confirmed
+
+ALERT_ACTION_TYPE = "pretix_xpay.event.refund_needed" # Log entries showing the manual refund requests on the orders
+ALERT_ATTACHMENT_DAYS = 7 # Days the CSV attached to a digest is kept
+
+API_CALL_TIMEOUT = 31.5 # Seconds, slightly more than a multiple of 3, to account for TCP retrasmission time
+JOURNAL_UNRESOLVED_GRACE = 120 # Seconds before a journaled call without outcome is considered unresolved, well above API_CALL_TIMEOUT
+JOURNAL_STATUS_RETENTION_DAYS = 30 # Journaled status requests and responses older than this are deleted; captures and refunds are kept forever
+
+EXPORT_CHUNK_SIZE = 2000 # Payments read at once by the exporters
+
+BULK_RELEASE_WORKERS = 8 # Default number of concurrent XPay calls while releasing preauthorizations in bulk
+
+# Default poller limits of each merchant, can be overridden in pretix's config file
+POLL_MAX_GROUPS = 2 # Merchants polled at the same time
+POLL_GROUP_CONCURRENCY = 2
+POLL_GROUP_RATE = 5.0 # Requests per second
+POLL_BREAKER_THRESHOLD = 5 # Consecutive failures
+POLL_BREAKER_COOLDOWN = 300 # Seconds
+
 # Table of supported languages by XPay: https://ecommerce.nexi.it/specifiche-tecniche/tabelleecodifiche/codificalanguageid.html
 LANGUAGE_DEFAULT = "ENG"
 LANGUAGES_TRANSLATION = {
@@ -37,4 +70,26 @@ LANGUAGES_TRANSLATION = {
     "ar": "ARA",
     "ru": "RUS",
     "pt": "POR",
-}
\ No newline at end of file
+}
+
+# ISO 4217 numeric codes, used by the back office api. Table of currencies accepted by XPay: https://ecommerce.nexi.it/specifiche-tecniche/tabelleecodifiche/codificadivisa.html
+CURRENCY_CODES = {
+    "EUR": "978",
+    "USD": "840",
+    "GBP": "826",
+    "CHF": "756",
+    "JPY": "392",
+    "CAD": "124",
+    "AUD": "036",
+    "DKK": "208",
+    "NOK": "578",
+    "SEK": "752",
+    "PLN": "985",
+    "CZK": "203",
+    "HUF": "348",
+    "RON": "946",
+    "HKD": "344",
+    "SGD": "702",
+    "CNY": "156",
+    "BRL": "986",
+}
@@ -0,0 +1,119 @@
+import json
+from collections import OrderedDict
+from django.db.models import OuterRef, Subquery
+from django.utils.translation import gettext_lazy as _, pgettext_lazy
+from pretix.base.exporter import BaseExporter, ListExporter, ProgressSetTotal
+from pretix.base.models import Event, OrderPayment
+from pretix_xpay.constants import EXPORT_CHUNK_SIZE
+from pretix_xpay.models import XPayApiCall
+from pretix_xpay.utils import OrderStatus, encode_order_id
+
+HEADERS = OrderedDict([
+    ("order", _("Order code")),
+    ("payment", _("Payment ID")),
+    ("transaction_code", _("Transaction code")),
+    ("amount", _("Amount")),
+    ("currency", _("Currency")),
+    ("state", _("Payment state")),
+    ("created", _("Created")),
+    ("payment_date", _("Payment date")),
+    ("cod_aut", _("Authorization code")),
+    ("esito", _("Return result")),
+    ("capture_time", _("Capture time")),
+    ("upstream_status", _("XPay status")),
+    ("upstream_checked_at", _("XPay status checked at")),
+])
+
+
+def iterate_transactions(event: Event):
+    """
+    Yields a dict for every XPay payment of the event, with bounded memory: payments are read with a server-side cursor
+    and the upstream data (last known XPay status and capture time) is taken from the api calls journal. Only the latest
+    status response and the first capture of each payment are looked up, one chunk at a time.
+    """
+    successful = XPayApiCall.objects.filter(payment_id=OuterRef("pk"), phase=XPayApiCall.PHASE_RESPONSE, esito="OK")
+    qs = OrderPayment.objects.filter(order__event=event, provider="xpay").select_related("order").annotate(
+        xpay_status_call_id=Subquery(
+            successful.filter(operation=XPayApiCall.OPERATION_STATUS).order_by("-timestamp", "-id").values("id")[:1]
+        ),
+        xpay_capture_time=Subquery(
+            successful.filter(operation=XPayApiCall.OPERATION_CAPTURE).order_by("timestamp", "id").values("timestamp")[:1]
+        ),
+    ).order_by("pk")
+    chunk = []
+    for payment in qs.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        chunk.append(payment)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield from _rows(event, chunk)
+            chunk = []
+    yield from _rows(event, chunk)
+
+
+def _rows(event: Event, payments: list):
+    if len(payments) == 0:
+        return
+    statuses = {
+        entry.payment_id: entry
+        for entry in XPayApiCall.objects.filter(
+            pk__in=[p.xpay_status_call_id for p in payments if p.xpay_status_call_id is not None]
+        ).only("payment_id", "transaction_code", "timestamp", "data")
+    }
+
+    for payment in payments:
+        payment.order.event = event
+        info = payment.info_data
+        status, checked_at = None, None
+        if payment.pk in statuses:
+            entry = statuses[payment.pk]
+            checked_at = entry.timestamp
+            try:
+                status = OrderStatus(entry.transaction_code, json.loads(entry.data)).status
+            except Exception:
+                status = None
+        yield {
+            "order": payment.order.code,
+            "payment": payment.full_id,
+            "transaction_code": encode_order_id(payment, event),
+            "amount": payment.amount,
+            "currency": event.currency,
+            "state": payment.state,
+            "created": payment.created.isoformat(),
+            "payment_date": payment.payment_date.isoformat() if payment.payment_date else None,
+            "cod_aut": info.get("codAut"),
+            "esito": info.get("esito"),
+            "capture_time": payment.xpay_capture_time.isoformat() if payment.xpay_capture_time else None,
+            "upstream_status": status,
+            "upstream_checked_at": checked_at.isoformat() if checked_at else None,
+        }
+
+
+class XPayTransactionsExporter(ListExporter):
+    identifier = "xpay_transactions"
+    verbose_name = _("XPay transactions")
+    category = pgettext_lazy("export_category", "Payments")
+    description = _("Download a spreadsheet of all the XPay transactions, with their authorization code, capture time and last known XPay status.")
+
+    def iterate_list(self, form_data):
+        yield ProgressSetTotal(total=OrderPayment.objects.filter(order__event=self.event, provider="xpay").count())
+        yield [str(label) for label in HEADERS.values()]
+        for row in iterate_transactions(self.event):
+            yield [row[key] if row[key] is not None else "" for key in HEADERS.keys()]
+
+    def get_filename(self):
+        return f"{self.event.slug}_xpay_transactions"
+
+
+class XPayTransactionsJSONExporter(BaseExporter):
+    identifier = "xpay_transactions_json"
+    verbose_name = _("XPay transactions (JSON)")
+    category = pgettext_lazy("export_category", "Payments")
+    description = _("Download all the XPay transactions as JSON lines, with their authorization code, capture time and last known XPay status.")
+
+    def render(self, form_data, output_file=None):
+        filename = f"{self.event.slug}_xpay_transactions.jsonl"
+        lines = (json.dumps(row, default=str) + "\n" for row in iterate_transactions(self.event))
+        if output_file is not None:
+            for line in lines:
+                output_file.write(line.encode("utf-8"))
+            return filename, "application/x-ndjson", None
+        return filename, "application/x-ndjson", "".join(lines).encode("utf-8")
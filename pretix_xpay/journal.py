@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from django.db import close_old_connections, connection
+from django.db.models import Exists, OuterRef
+from django.utils.timezone import now
+from pretix.base.models import OrderPayment
+from pretix_xpay.constants import ENDPOINT_ORDERS_CONFIRM, ENDPOINT_ORDERS_CANCEL, ENDPOINT_ORDERS_STATUS, JOURNAL_UNRESOLVED_GRACE, JOURNAL_STATUS_RETENTION_DAYS
+from pretix_xpay.constants import XPAY_OPERATION_CAPTURE, XPAY_OPERATION_REFUND, XPAY_RESULT_AUTHORIZED, XPAY_RESULT_CANCELED, XPAY_RESULT_CAPTURED, XPAY_RESULT_PENDING, XPAY_RESULT_REFUNDED
+from pretix_xpay.models import XPayApiCall
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = {
+    ENDPOINT_ORDERS_CONFIRM: XPayApiCall.OPERATION_CAPTURE,
+    ENDPOINT_ORDERS_CANCEL: XPayApiCall.OPERATION_REFUND,
+    ENDPOINT_ORDERS_STATUS: XPayApiCall.OPERATION_STATUS,
+}
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def _create_committed(**fields) -> XPayApiCall:
+    """
+    Writes a journal entry so that it is committed right away, even if the caller is inside a transaction:
+    an entry rolled back together with the caller's transaction (or lost with the process) would defeat the journal.
+    Inside a transaction the entry is written by a dedicated thread, on its own autocommit connection.
+    """
+    global _writer
+    # SQLite (development only) allows a single writer: a second connection would wait for the caller's transaction
+    if not connection.in_atomic_block or connection.vendor == "sqlite":
+        return XPayApiCall.objects.create(**fields)
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pretix_xpay_journal")
+    return _writer.submit(_write, fields).result()
+
+def _write(fields: dict) -> XPayApiCall:
+    close_old_connections()
+    return XPayApiCall.objects.create(**fields)
+
+def record_request(path: str, body: dict, payment: OrderPayment = None) -> XPayApiCall:
+    '''Journals an api call before it is sent to XPay'''
+    serialized = json.dumps(body, sort_keys=True, default=str)
+    return _create_committed(
+        call_id=uuid.uuid4(),
+        transaction_code=body.get("codiceTransazione", ""),
+        payment_id=payment.pk if payment else None,
+        operation=OPERATIONS.get(path, path),
+        phase=XPayApiCall.PHASE_REQUEST,
+        request_hash=hashlib.sha256(serialized.encode("utf-8")).hexdigest(),
+    )
+
+def record_response(call: XPayApiCall, result: dict) -> XPayApiCall:
+    '''Journals the response of an api call'''
+    return _record_outcome(call, XPayApiCall.PHASE_RESPONSE, result.get("esito"), result.get("idOperazione"), json.dumps(_strip_personal_data(result), default=str))
+
+def _strip_personal_data(result: dict) -> dict:
+    '''Keeps only the fields needed to reconstruct the transaction's history: captures and refunds are never pruned'''
+    stripped = {k: result[k] for k in ("esito", "idOperazione", "timeStamp", "errore") if k in result}
+    if isinstance(result.get("report"), list):
+        stripped["report"] = [{
+            "codiceTransazione": report.get("codiceTransazione"),
+            "stato": report.get("stato"),
+            "dettaglio": [{
+                "stato": detail.get("stato"),
+                "operazioni": [
+                    {k: op.get(k) for k in ("tipoOperazione", "stato", "dataOperazione")}
+                    for op in detail.get("operazioni", []) if isinstance(op, dict)
+                ],
+            } for detail in report.get("dettaglio", []) if isinstance(detail, dict)],
+        } for report in result["report"] if isinstance(report, dict)]
+    return stripped
+
+def record_error(call: XPayApiCall, error: str) -> XPayApiCall:
+    '''Journals an api call which didn't get a response (eg: timeout or connection error)'''
+    return _record_outcome(call, XPayApiCall.PHASE_ERROR, None, None, error)
+
+def record_verification(call: XPayApiCall, landed: bool, status: str) -> XPayApiCall:
+    '''Journals the outcome of an unresolved call, as found by a later status check'''
+    return _record_outcome(call, XPayApiCall.PHASE_VERIFIED, "OK" if landed else "MISSING", None, status)
+
+def _record_outcome(call: XPayApiCall, phase: str, esito: str, operation_id: str, data: str) -> XPayApiCall:
+    return _create_committed(
+        call_id=call.call_id,
+        transaction_code=call.transaction_code,
+        payment_id=call.payment_id,
+        operation=call.operation,
+        phase=phase,
+        request_hash=call.request_hash,
+        esito=esito,
+        operation_id=str(operation_id) if operation_id is not None else None,
+        data=data,
+    )
+
+def get_unresolved_calls(since: datetime = None, operations: list = None):
+    """
+    Returns the journaled requests which never got a response, an error or a verification.
+    Their outcome is unknown: XPay may or may not have executed them.
+    Recent requests are left out, as they may still be waiting for their response.
+
+    :param datetime since: only include requests sent after this moment
+    :param list operations: only include these operations. Defaults to capture and refund
+    """
+    outcomes = XPayApiCall.objects.filter(call_id=OuterRef("call_id")).exclude(phase=XPayApiCall.PHASE_REQUEST)
+    qs = XPayApiCall.objects.filter(
+        phase=XPayApiCall.PHASE_REQUEST,
+        operation__in=operations or [XPayApiCall.OPERATION_CAPTURE, XPayApiCall.OPERATION_REFUND],
+        timestamp__lt=now() - timedelta(seconds=JOURNAL_UNRESOLVED_GRACE),
+    ).exclude(Exists(outcomes))
+    if since is not None:
+        qs = qs.filter(timestamp__gte=since)
+    return qs
+
+def prune_status_calls() -> int:
+    '''Deletes the journaled status requests older than JOURNAL_STATUS_RETENTION_DAYS. Returns the number of deleted entries'''
+    deleted, _ = XPayApiCall.objects.filter(
+        operation=XPayApiCall.OPERATION_STATUS,
+        timestamp__lt=now() - timedelta(days=JOURNAL_STATUS_RETENTION_DAYS),
+    ).delete()
+    return deleted
+
+def get_history(transaction_code: str):
+    '''Returns every journal entry of a transaction, oldest first'''
+    return XPayApiCall.objects.filter(transaction_code=transaction_code)
+
+def verify_call(call: XPayApiCall, replay: bool = False) -> str:
+    """
+    Checks on XPay whether an unresolved capture or refund was executed, journaling the result.
+    If it wasn't and replay is True, the operation is sent again when both the transaction and the pretix payment still allow it:
+    a capture only for confirmed payments, a refund only for the ones which aren't confirmed.
+
+    :param XPayApiCall call: an unresolved request, as returned by get_unresolved_calls
+    :param bool replay: whether to send again the operations which didn't land
+    :return: one of "landed", "missing", "replayed" or "payment_not_found"
+    :rtype: str
+    """
+    import pretix_xpay.xpay_api as xpay
+
+    payment = OrderPayment.objects.filter(pk=call.payment_id).select_related("order", "order__event", "order__event__organizer").first()
+    if payment is None:
+        return "payment_not_found"
+    provider = payment.payment_provider
+    status = xpay.get_order_status(payment=payment, provider=provider)
+    operation_types = [op.type for op in status.operations]
+
+    if call.operation == XPayApiCall.OPERATION_CAPTURE:
+        landed = status.status in XPAY_RESULT_CAPTURED or XPAY_OPERATION_CAPTURE in operation_types
+        can_replay = status.status in XPAY_RESULT_AUTHORIZED and payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    else:
+        landed = status.status in XPAY_RESULT_REFUNDED or status.status in XPAY_RESULT_CANCELED or XPAY_OPERATION_REFUND in operation_types
+        can_replay = (status.status in XPAY_RESULT_AUTHORIZED or status.status in XPAY_RESULT_PENDING) and payment.state != OrderPayment.PAYMENT_STATE_CONFIRMED
+    record_verification(call, landed, status.status)
+    logger.info(f"XPAY_journal_verify_call [{payment.full_id}]: {call.operation} sent at {call.timestamp} {'landed' if landed else 'is missing'}, status {status.status}")
+
+    if landed:
+        return "landed"
+    if replay and can_replay:
+        if call.operation == XPayApiCall.OPERATION_CAPTURE:
+            xpay.confirm_preauth(payment, provider)
+        else:
+            xpay.refund_preauth(payment, provider, notify=False)
+        return "replayed"
+    return "missing"
@@ -0,0 +1,328 @@
+import json
+import logging
+import random
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Order, OrderPayment
+import pretix_xpay.xpay_api as xpay
+from pretix_xpay import tracing
+from pretix_xpay.models import XPayApiCall
+from pretix_xpay.constants import HASH_TAG, ENDPOINT_ORDERS_CONFIRM, ENDPOINT_ORDERS_CANCEL, ENDPOINT_ORDERS_STATUS
+from pretix_xpay.payment import XPayPaymentProvider
+from pretix_xpay.poller import poll_in_groups
+from pretix_xpay.utils import generate_mac, run_concurrently
+
+logger = logging.getLogger(__name__)
+
+# Tools to measure how many checkouts per second a node can settle.
+# A local stand-in plays XPay's role, while the flows go through the real views, api calls and poller.
+
+FLOW_OK = "ok"
+FLOW_KO = "ko"
+FLOW_PENDING = "pen"
+
+
+class XPayStandIn:
+    """
+    Minimal in-process XPay: it signs the return parameters like the hosted page would do and answers to
+    the capture, refund and status back office calls, keeping the transactions in memory.
+    """
+
+    def __init__(self, provider: XPayPaymentProvider, latency: float = 0.0, pending_delay: float = 5.0):
+        self.provider = provider
+        self.latency = latency
+        self.pending_delay = pending_delay
+        self.transactions = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def authorize(self, params: dict, esito: str) -> dict:
+        '''Simulates the user on the hosted page and returns the GET parameters XPay sends back to the return view'''
+        status = {"OK": "Autorizzato", "PEN": "In Corso"}.get(esito, "Annullato")
+        with self.lock:
+            self.transactions[params["codTrans"]] = {"status": status, "since": time.monotonic()}
+        stamp = now()
+        data = [
+            ("codTrans", params["codTrans"]),
+            ("esito", esito),
+            ("importo", params["importo"]),
+            ("divisa", params["divisa"]),
+            ("data", stamp.strftime("%Y%m%d")),
+            ("orario", stamp.strftime("%H%M%S")),
+            ("codAut", f"{random.randint(0, 999999):06d}"),
+        ]
+        return {**dict((k, str(v)) for k, v in data), "mac": generate_mac(data, self.provider)}
+
+    def _answer(self, path: str, body: dict) -> dict:
+        transaction_code = body.get("codiceTransazione")
+        with self.lock:
+            transaction = self.transactions.get(transaction_code)
+            if transaction and transaction["status"] == "In Corso" and time.monotonic() - transaction["since"] > self.pending_delay:
+                transaction["status"] = "Autorizzato"
+
+            if transaction is None:
+                return self._signed({"esito": "KO", "errore": {"codice": 2, "messaggio": "Not found"}})
+            if path == ENDPOINT_ORDERS_CONFIRM:
+                transaction["status"] = "Contabilizzato"
+                return self._signed({"esito": "OK"})
+            if path == ENDPOINT_ORDERS_CANCEL:
+                transaction["status"] = "Stornato"
+                return self._signed({"esito": "OK"})
+            if path == ENDPOINT_ORDERS_STATUS:
+                return self._signed({"esito": "OK", "report": [{
+                    "codiceTransazione": transaction_code,
+                    "stato": transaction["status"],
+                    "dettaglio": [{"stato": transaction["status"], "operazioni": []}],
+                }]})
+        return self._signed({"esito": "KO", "errore": {"codice": 1, "messaggio": "Unknown endpoint"}})
+
+    def _signed(self, result: dict) -> dict:
+        result["idOperazione"] = str(random.randint(0, 10 ** 9))
+        result["timeStamp"] = int(time.time() * 1000)
+        result["mac"] = generate_mac([
+            ("esito", result["esito"]),
+            ("idOperazione", result["idOperazione"]),
+            ("timeStamp", result["timeStamp"])
+        ], self.provider)
+        return result
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                data = json.dumps(stand_in._answer(self.path.lstrip("/"), body)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class LoadTestStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.lock_waits = []
+        self.flows = {}
+        self.errors = {}
+
+    def record_span(self, span: tracing.Span):
+        with self.lock:
+            self.spans.setdefault(span.name, []).append(span.duration_ms)
+
+    def record_lock_wait(self, duration_ms: float):
+        with self.lock:
+            self.lock_waits.append(duration_ms)
+
+    def record_flow(self, kind: str, duration_ms: float, error: Exception = None):
+        with self.lock:
+            self.flows.setdefault(kind, []).append(duration_ms)
+            if error is not None:
+                self.errors.setdefault(kind, []).append(repr(error))
+
+    def report(self, elapsed: float, payment_states: dict) -> dict:
+        total = sum(len(v) for v in self.flows.values())
+        return {
+            "flows": total,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_flows_s": round(total / elapsed, 2) if elapsed else None,
+            "flow_latency_ms": {kind: percentiles(values) for kind, values in self.flows.items()},
+            "span_latency_ms": {name: percentiles(values) for name, values in self.spans.items()},
+            "lock_waits_ms": percentiles(self.lock_waits),
+            "error_rate": {kind: round(len(self.errors.get(kind, [])) / len(values), 4) for kind, values in self.flows.items()},
+            "errors": {kind: sorted(set(errors))[:10] for kind, errors in self.errors.items()},
+            "payment_states": payment_states,
+        }
+
+
+def percentiles(values: list) -> dict:
+    if len(values) == 0:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 3),
+        "p50": pick(50),
+        "p90": pick(90),
+        "p99": pick(99),
+        "max": values[-1],
+    }
+
+
+def create_orders(event: Event, count: int) -> list:
+    '''Creates pending test mode orders, each with a single position of the first active item and a new XPay payment'''
+    item = event.items.filter(active=True).first()
+    if item is None:
+        raise ValueError("The event has no active item")
+    payments = []
+    for i in range(count):
+        order = Order.objects.create(
+            event=event,
+            email="loadtest@example.org",
+            status=Order.STATUS_PENDING,
+            locale="en",
+            total=item.default_price,
+            expires=now() + timedelta(days=1),
+            testmode=True,
+            sales_channel=event.organizer.sales_channels.get(identifier="web"),
+        )
+        order.positions.create(item=item, price=item.default_price, positionid=1, attendee_name_parts={})
+        payments.append(order.payments.create(provider="xpay", amount=item.default_price, state=OrderPayment.PAYMENT_STATE_CREATED))
+    return payments
+
+
+def delete_orders(payments: list) -> None:
+    '''Deletes the test mode orders created by create_orders, together with the journal entries of their payments'''
+    with transaction.atomic():
+        XPayApiCall.objects.filter(payment_id__in=[p.pk for p in payments]).delete()
+        for order in Order.objects.filter(pk__in=[p.order_id for p in payments], testmode=True):
+            order.gracefully_delete()
+
+
+@contextmanager
+def lock_wait_probe(stats: LoadTestStats):
+    '''Times the row locking queries executed on the current thread's connection'''
+    def wrapper(execute, sql, params, many, context):
+        if "FOR UPDATE" not in sql:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats.record_lock_wait((time.perf_counter() - start) * 1000)
+
+    with connection.execute_wrapper(wrapper):
+        yield
+
+
+def run_load_test(event: Event, flows: int, concurrency: int, mix: dict, poll_interval: float = 2.0, latency: float = 0.0, pending_delay: float = 5.0, progress=None, keep_orders: bool = False) -> dict:
+    """
+    Drives many concurrent checkouts through the real views: redirect params generation, then the return with
+    the result chosen by mix, then the capture. Meanwhile the poller runs in background, settling the pending payments.
+    Only the payments created by the load test are polled, and their orders are deleted at the end unless keep_orders is True.
+
+    :param Event event: a test mode event with XPay configured
+    :param int flows: the number of checkouts to simulate
+    :param int concurrency: the number of concurrent checkouts
+    :param dict mix: the weight of each result (FLOW_OK, FLOW_KO, FLOW_PENDING)
+    :param float poll_interval: seconds between two runs of the poller
+    :param float latency: seconds the stand-in waits before answering to an api call
+    :param float pending_delay: seconds before a pending transaction becomes authorized on the stand-in
+    :param Callable progress: optional callback, called with (done, total) after each checkout
+    :param bool keep_orders: whether to keep the orders created by the load test
+    :return: the report
+    :rtype: dict
+    """
+    from pretix_xpay.signals import poll_payment
+    from pretix_xpay.views import RedirectView, ReturnView
+
+    if not event.testmode:
+        raise ValueError("Load tests can only run on events in test mode")
+    provider = XPayPaymentProvider(event)
+    stats = LoadTestStats()
+    factory = RequestFactory()
+    kinds = random.choices(list(mix.keys()), weights=list(mix.values()), k=flows)
+    with scopes_disabled():
+        payments = create_orders(event, flows)
+
+    def request_for(path: str, data: dict = None):
+        request = factory.get(path, data or {})
+        request.event = event
+        request.organizer = event.organizer
+        request._messages = CookieStorage(request)
+        return request
+
+    def flow(job):
+        kind, payment = job
+        order = payment.order
+        kwargs = {"organizer": event.organizer.slug, "event": event.slug, "order": order.code, "hash": order.tagged_secret(HASH_TAG), "payment": str(payment.pk)}
+        start = time.perf_counter()
+        error = None
+        try:
+            with lock_wait_probe(stats):
+                response = RedirectView.as_view()(request_for("/redirect/"), **kwargs)
+                params = response.context_data["params"]
+                esito = {FLOW_OK: "OK", FLOW_PENDING: "PEN"}.get(kind, "ANNULLO")
+                data = stand_in.authorize(params, esito)
+                ReturnView.as_view()(request_for("/return/", data), result="ko" if kind == FLOW_KO else "ok", **kwargs)
+        except Exception as e:
+            error = e
+        stats.record_flow(kind, (time.perf_counter() - start) * 1000, error)
+
+    done = threading.Event()
+    group = (provider.settings.alias_key or "", "test")
+
+    def poller():
+        try:
+            while not done.wait(poll_interval):
+                with scopes_disabled(), lock_wait_probe(stats):
+                    pending = list(OrderPayment.objects.filter(
+                        pk__in=[p.pk for p in payments],
+                        state__in=[OrderPayment.PAYMENT_STATE_PENDING, OrderPayment.PAYMENT_STATE_CREATED],
+                    ).select_related("order"))
+                    for payment in pending:
+                        payment.order.event = event
+                        payment.payment_provider # Load the providers before the workers share them
+                    if len(pending) > 0:
+                        poll_in_groups({group: pending}, poll_payment)
+        finally:
+            connection.close()
+
+    tracing.add_sink(stats.record_span)
+    try:
+        with XPayStandIn(provider, latency, pending_delay) as stand_in, mock.patch.object(xpay, "get_xpay_api_url", lambda provider: stand_in.url):
+            poll_thread = threading.Thread(target=poller, daemon=True)
+            poll_thread.start()
+            try:
+                start = time.perf_counter()
+                run_concurrently(list(zip(kinds, payments)), flow, concurrency, progress)
+                elapsed = time.perf_counter() - start
+                # Let the poller settle the pending payments
+                time.sleep(pending_delay + poll_interval)
+            finally:
+                done.set()
+                poll_thread.join()
+
+        with scopes_disabled():
+            states = {}
+            for state in OrderPayment.objects.filter(pk__in=[p.pk for p in payments]).values_list("state", flat=True):
+                states[state] = states.get(state, 0) + 1
+    finally:
+        tracing.remove_sink(stats.record_span)
+        if not keep_orders:
+            with scopes_disabled():
+                delete_orders(payments)
+    return stats.report(elapsed, states)
@@ -0,0 +1,28 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+
+
+class Command(BaseCommand):
+    help = "Checks on XPay the journaled captures and refunds whose outcome is unknown, optionally sending again the missing ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since-hours", type=int, default=72, help="Only check the calls sent in the last hours")
+        parser.add_argument("--replay", action="store_true", help="Send again the captures and refunds which didn't land")
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        from pretix_xpay.journal import get_unresolved_calls, verify_call
+
+        counts = {}
+        for call in get_unresolved_calls(since=now() - timedelta(hours=options["since_hours"])):
+            try:
+                outcome = verify_call(call, replay=options["replay"])
+            except Exception as e:
+                outcome = "error"
+                self.stderr.write(f"{call.transaction_code} {call.operation}: {repr(e)}")
+            self.stdout.write(f"{call.transaction_code} {call.operation} {call.timestamp.isoformat()}: {outcome}")
+            counts[outcome] = counts.get(outcome, 0) + 1
+        for outcome, count in counts.items():
+            self.stdout.write(f"{outcome}: {count}")
@@ -0,0 +1,58 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django_scopes import scopes_disabled
+from pretix.base.models import Event
+
+
+class Command(BaseCommand):
+    help = "Simulates many concurrent XPay checkouts against a local XPay stand-in and reports throughput and latencies"
+
+    def add_arguments(self, parser):
+        parser.add_argument("organizer", type=str, help="Organizer's slug")
+        parser.add_argument("event", type=str, help="Event's slug. The event must be in test mode and have XPay configured")
+        parser.add_argument("--flows", type=int, default=200, help="Number of checkouts to simulate")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent checkouts")
+        parser.add_argument("--mix", type=str, default="ok=80,ko=10,pen=10", help="Weights of the checkout results, eg: ok=80,ko=10,pen=10")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between two runs of the poller")
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds the stand-in waits before answering to an api call")
+        parser.add_argument("--pending-delay", type=float, default=5.0, help="Seconds before a pending transaction becomes authorized")
+        parser.add_argument("--keep-orders", action="store_true", help="Keep the orders created by the load test instead of deleting them")
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        from pretix_xpay.loadtest import FLOW_OK, FLOW_KO, FLOW_PENDING, run_load_test
+
+        try:
+            event = Event.objects.select_related("organizer").get(slug=options["event"], organizer__slug=options["organizer"])
+        except Event.DoesNotExist:
+            raise CommandError("Event not found")
+        if not event.testmode:
+            raise CommandError("Load tests can only run on events in test mode, as they create orders")
+
+        try:
+            mix = {kind: float(weight) for kind, weight in (part.split("=") for part in options["mix"].split(","))}
+        except ValueError:
+            raise CommandError("Invalid mix")
+        if not set(mix.keys()) <= {FLOW_OK, FLOW_KO, FLOW_PENDING}:
+            raise CommandError(f"Invalid mix, allowed results are {FLOW_OK}, {FLOW_KO} and {FLOW_PENDING}")
+
+        def progress(done: int, total: int):
+            self.stdout.write(f"\r{done}/{total}", ending="")
+            self.stdout.flush()
+
+        try:
+            report = run_load_test(
+                event,
+                flows=options["flows"],
+                concurrency=max(options["concurrency"], 1),
+                mix=mix,
+                poll_interval=options["poll_interval"],
+                latency=options["latency"],
+                pending_delay=options["pending_delay"],
+                progress=progress,
+                keep_orders=options["keep_orders"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("")
+        self.stdout.write(json.dumps(report, indent=2, default=str))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_scopes import scopes_disabled
+from pretix.base.models import Event
+from pretix_xpay.constants import BULK_RELEASE_WORKERS
+
+
+class Command(BaseCommand):
+    help = "Releases all the authorized but not captured XPay payments of an event"
+
+    def add_arguments(self, parser):
+        parser.add_argument("organizer", type=str, help="Organizer's slug")
+        parser.add_argument("event", type=str, help="Event's slug")
+        parser.add_argument("--workers", type=int, default=BULK_RELEASE_WORKERS, help="Maximum number of concurrent calls to XPay")
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        from pretix_xpay.tasks import release_event_preauths
+
+        try:
+            event = Event.objects.select_related("organizer").get(slug=options["event"], organizer__slug=options["organizer"])
+        except Event.DoesNotExist:
+            raise CommandError("Event not found")
+
+        def progress(done: int, total: int):
+            self.stdout.write(f"\r{done}/{total}", ending="")
+            self.stdout.flush()
+
+        results = release_event_preauths(event, max_workers=max(options["workers"], 1), progress=progress, origin="manage.py xpay_release_preauths")
+        self.stdout.write("")
+        for outcome, payments in results.items():
+            self.stdout.write(f"{outcome}: {len(payments)}")
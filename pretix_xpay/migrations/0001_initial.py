@@ -0,0 +1,32 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="XPayApiCall",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("call_id", models.UUIDField(db_index=True)),
+                ("transaction_code", models.CharField(db_index=True, max_length=32)),
+                ("payment_id", models.BigIntegerField(db_index=True, null=True)),
+                ("operation", models.CharField(max_length=16)),
+                ("phase", models.CharField(max_length=16)),
+                ("timestamp", models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ("request_hash", models.CharField(max_length=64)),
+                ("esito", models.CharField(max_length=32, null=True)),
+                ("operation_id", models.CharField(max_length=64, null=True)),
+                ("data", models.TextField(null=True)),
+            ],
+            options={
+                "ordering": ("timestamp", "id"),
+                "indexes": [models.Index(fields=["transaction_code", "timestamp"], name="xpay_apicall_code_time_idx")],
+            },
+        ),
+    ]
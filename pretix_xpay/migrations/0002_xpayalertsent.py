@@ -0,0 +1,21 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_xpay", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="XPayAlertSent",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("log_entry_id", models.BigIntegerField(unique=True)),
+                ("event_id", models.BigIntegerField(db_index=True)),
+                ("sent_at", models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
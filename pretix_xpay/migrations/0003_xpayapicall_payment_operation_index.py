@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_xpay", "0002_xpayalertsent"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="xpayapicall",
+            index=models.Index(fields=["payment_id", "operation", "timestamp"], name="xpay_apicall_pay_op_time_idx"),
+        ),
+    ]
@@ -0,0 +1,30 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_xpay", "0003_xpayapicall_payment_operation_index"),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name="XPayAlertSent",
+        ),
+        migrations.CreateModel(
+            name="XPayAlert",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("event_id", models.BigIntegerField(db_index=True)),
+                ("payment_id", models.BigIntegerField(null=True)),
+                ("payment_full_id", models.CharField(max_length=190)),
+                ("transaction_id", models.CharField(max_length=32)),
+                ("origin", models.CharField(max_length=190)),
+                ("created", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                "ordering": ("created", "id"),
+            },
+        ),
+    ]
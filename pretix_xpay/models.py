@@ -0,0 +1,60 @@
+from django.db import models
+from django.utils.timezone import now
+
+
+class XPayApiCall(models.Model):
+    """
+    Append-only journal of the calls to XPay's back office api.
+    Every call writes a request entry before being sent and a response (or error) entry once it's over, sharing the same call_id.
+    A request entry without its response means the outcome is unknown (eg: crash or timeout) and should be verified.
+    """
+    PHASE_REQUEST = "request"
+    PHASE_RESPONSE = "response"
+    PHASE_ERROR = "error"
+    PHASE_VERIFIED = "verified"
+
+    OPERATION_CAPTURE = "capture"
+    OPERATION_REFUND = "refund"
+    OPERATION_STATUS = "status"
+
+    id = models.BigAutoField(primary_key=True)
+    call_id = models.UUIDField(db_index=True)
+    transaction_code = models.CharField(max_length=32, db_index=True)
+    payment_id = models.BigIntegerField(null=True, db_index=True) # Not a foreign key: entries must outlive the payments
+    operation = models.CharField(max_length=16)
+    phase = models.CharField(max_length=16)
+    timestamp = models.DateTimeField(default=now, db_index=True)
+    request_hash = models.CharField(max_length=64)
+    esito = models.CharField(max_length=32, null=True)
+    operation_id = models.CharField(max_length=64, null=True) # XPay's idOperazione
+    data = models.TextField(null=True)
+
+    class Meta:
+        ordering = ("timestamp", "id")
+        indexes = [
+            models.Index(fields=["transaction_code", "timestamp"], name="xpay_apicall_code_time_idx"),
+            models.Index(fields=["payment_id", "operation", "timestamp"], name="xpay_apicall_pay_op_time_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("Journal entries can't be modified")
+        super().save(*args, **kwargs)
+
+
+
+class XPayAlert(models.Model):
+    """
+    Queue of the manual refund requests which weren't sent to the operators yet.
+    Every request is also written in the order's log, for display; the queue entries are deleted once included in a digest.
+    """
+    id = models.BigAutoField(primary_key=True)
+    event_id = models.BigIntegerField(db_index=True) # Not a foreign key, like the journal
+    payment_id = models.BigIntegerField(null=True)
+    payment_full_id = models.CharField(max_length=190)
+    transaction_id = models.CharField(max_length=32)
+    origin = models.CharField(max_length=190)
+    created = models.DateTimeField(default=now)
+
+    class Meta:
+        ordering = ("created", "id")
@@ -5,14 +5,17 @@ from collections import OrderedDict
 from django import forms
 from django.http import HttpRequest, Http404
 from django.template.loader import get_template
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from pretix.base.forms import SecretKeySettingsField
 from pretix.base.models import Event, OrderPayment
 from pretix.base.payment import BasePaymentProvider, PaymentException
 from pretix.base.settings import SettingsSandbox
 from pretix.multidomain.urlreverse import eventreverse
-from pretix_xpay.constants import TEST_URL, DOCS_TEST_CARDS_URL, HASH_TAG, XPAY_RESULT_AUTHORIZED, XPAY_RESULT_PENDING, XPAY_RESULT_CAPTURED, XPAY_RESULT_REFUNDED, XPAY_RESULT_CANCELED
-from pretix_xpay.utils import send_refund_needed_email, get_settings_object
+from pretix_xpay.constants import TEST_URL, DOCS_TEST_CARDS_URL, HASH_TAG, XPAY_RESULT_AUTHORIZED, XPAY_RESULT_PENDING, XPAY_RESULT_CAPTURED, XPAY_RESULT_REFUNDED, XPAY_RESULT_CANCELED, CURRENCY_CODES
+from pretix_xpay.constants import RELEASE_REFUNDED, RELEASE_ALREADY_RELEASED, RELEASE_NOT_FOUND, RELEASE_CAPTURED, RELEASE_UNKNOWN, RELEASE_SKIPPED
+from pretix_xpay.signer import MacSigner
+from pretix_xpay.utils import report_refund_needed, get_settings_object, claim_payment_release
 
 logger = logging.getLogger(__name__)
 
@@ -87,6 +90,20 @@ class XPayPaymentProvider(BasePaymentProvider):
                     ),
                 )
             ),
+            (
+                "alert_digest_interval",
+                forms.IntegerField(
+                    label=_("Failed payments digest interval (mins)"),
+                    min_value = 1,
+                    max_value = 10080,
+                    step_size = 1,
+                    required = False,
+                    help_text=_(
+                        'Manual verification requests are collected and sent as a single digest email, deduplicated by payment. '
+                        'This specifies how long a request waits in the queue before the digest is sent.'
+                    ),
+                ),
+            ),
             (
                 "enable_test_endpoints",
                 forms.BooleanField(
@@ -101,6 +118,11 @@ class XPayPaymentProvider(BasePaymentProvider):
         d.move_to_end("_enabled", last=False)
         return d
     
+    @cached_property
+    def signer(self) -> MacSigner:
+        '''Computes and verifies the MACs with the merchant's hash algorithm and secret'''
+        return MacSigner(self.settings.hash or "sha1", self.settings.mac_secret_pass)
+
     @property
     def test_mode_message(self):
         if self.event.testmode:
@@ -110,6 +132,10 @@ class XPayPaymentProvider(BasePaymentProvider):
             )
         return None
     
+    def is_allowed(self, request: HttpRequest, total=None) -> bool:
+        '''Hides the provider for events whose currency XPay can't handle'''
+        return self.event.currency in CURRENCY_CODES and super().is_allowed(request, total)
+
     def cancel_payment(self, payment: OrderPayment):
         """
         Overrides the default cancel_payment to add a couple of checks.
@@ -118,36 +144,62 @@ class XPayPaymentProvider(BasePaymentProvider):
         :raises Exception: if the payment is not found or already accounted
         """
         try:
-            try:
-                order_status = xpay.get_order_status(payment=payment, provider=self)
-            except Http404:
-                logger.error(f"XPAY_cancel_payment [{payment.full_id}]: Order not found")
-                super().cancel_payment(payment)
+            outcome = self.release_preauth(payment)
+            if outcome == RELEASE_NOT_FOUND:
                 raise Exception("Payment not found")
+            elif outcome == RELEASE_CAPTURED:
+                raise Exception("Pre-authorized payment was already captured")
+            elif outcome == RELEASE_UNKNOWN:
+                raise Exception("Unknown state")
 
-            if order_status.status in XPAY_RESULT_AUTHORIZED or order_status.status in XPAY_RESULT_PENDING:
-                xpay.refund_preauth(payment, self)
-                super().cancel_payment(payment)
+        except BaseException as e:
+            logger.warning(f"A warning occurred while trying to cancel the payment {payment.full_id}: {repr(e)}")
 
-            elif order_status.status in XPAY_RESULT_CAPTURED:
-                logger.info(f"XPAY_cancel_payment [{payment.full_id}]: Preauthorized payment was already captured!")
-                super().cancel_payment(payment)
-                send_refund_needed_email(payment, origin="XPayPaymentProvider.cancel_payment")
-                raise Exception("Pre-authorized payment was already captured")
+    def release_preauth(self, payment: OrderPayment, notify: bool = True) -> str:
+        """
+        Cancels a payment and releases its preauthorized money (if any).
+        The payment is canceled first, under a row lock, so it can't be confirmed while its money is being released;
+        a payment which was confirmed or settled in the meantime is skipped.
 
-            elif order_status.status in XPAY_RESULT_REFUNDED or order_status.status in XPAY_RESULT_CANCELED:
-                logger.info(f"XPAY_cancel_payment [{payment.full_id}]: Payment was already in refunded or canceled state")
-                super().cancel_payment(payment)
+        :param OrderPayment payment: the order's payment
+        :param bool notify: whether to send the manual refund email on failures. Bulk operations disable it and send an aggregated report instead
+        :return: one of the RELEASE_* outcomes
+        :rtype: str
+        :raises PaymentException: if the refund request fails. The payment stays canceled and, with notify, a manual refund is reported
+        """
+        if not claim_payment_release(payment, super().cancel_payment):
+            logger.info(f"XPAY_cancel_payment [{payment.full_id}]: Payment is not created or pending anymore, skipping it.")
+            return RELEASE_SKIPPED
 
-            else:
-                super().cancel_payment(payment)
-                raise Exception(f"Unknown state: {order_status.status}")
+        try:
+            order_status = xpay.get_order_status(payment=payment, provider=self)
+        except Http404:
+            logger.error(f"XPAY_cancel_payment [{payment.full_id}]: Order not found")
+            return RELEASE_NOT_FOUND
+        except Exception:
+            # The payment is already canceled: its money, if any, must be released by hand
+            if notify:
+                report_refund_needed(payment, origin="XPayPaymentProvider.cancel_payment-status")
+            raise
 
-        except BaseException as e:
-            logger.warning(f"A warning occurred while trying to cancel the payment {payment.full_id}: {repr(e)}")
+        if order_status.status in XPAY_RESULT_AUTHORIZED or order_status.status in XPAY_RESULT_PENDING:
+            xpay.refund_preauth(payment, self, notify=notify)
+            return RELEASE_REFUNDED
+
+        elif order_status.status in XPAY_RESULT_CAPTURED:
+            logger.info(f"XPAY_cancel_payment [{payment.full_id}]: Preauthorized payment was already captured!")
+            if notify:
+                report_refund_needed(payment, origin="XPayPaymentProvider.cancel_payment")
+            return RELEASE_CAPTURED
+
+        elif order_status.status in XPAY_RESULT_REFUNDED or order_status.status in XPAY_RESULT_CANCELED:
+            logger.info(f"XPAY_cancel_payment [{payment.full_id}]: Payment was already in refunded or canceled state")
+            return RELEASE_ALREADY_RELEASED
+
+        else:
+            logger.warning(f"XPAY_cancel_payment [{payment.full_id}]: Unknown state: {order_status.status}")
+            return RELEASE_UNKNOWN
 
-        
-    
     def payment_form_render(self, request) -> str:
         '''Renders an explainatory paragraph'''
         template = get_template("pretix_xpay/checkout_payment_form.html")
@@ -0,0 +1,125 @@
+import hashlib
+import logging
+import threading
+import time
+from typing import Callable
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from pretix_xpay.constants import POLL_MAX_GROUPS, POLL_GROUP_CONCURRENCY, POLL_GROUP_RATE, POLL_BREAKER_THRESHOLD, POLL_BREAKER_COOLDOWN
+from pretix_xpay.utils import run_concurrently
+
+logger = logging.getLogger(__name__)
+
+# The poller processes the pending payments grouped by merchant (alias and environment), so a slow or misconfigured
+# merchant can't starve the others. At most poll_max_groups * poll_group_concurrency threads, each one with its own
+# database connection, run at the same time. The limits are set in pretix's config file:
+#
+# [pretix_xpay]
+# poll_max_groups=2 ; merchants polled at the same time
+# poll_group_concurrency=2 ; concurrent status requests of each merchant
+# poll_group_rate=5 ; maximum status requests per second of each merchant
+# poll_breaker_threshold=5 ; consecutive failures after which a merchant is skipped
+# poll_breaker_cooldown=300 ; seconds a merchant is skipped for
+
+
+def get_config(key: str, fallback):
+    config = getattr(django_settings, "CONFIG_FILE", None)
+    if config is None or not config.has_option("pretix_xpay", key):
+        return fallback
+    return type(fallback)(config.get("pretix_xpay", key))
+
+
+class RateLimiter:
+    '''Spaces the calls of a group so that at most `rate` start every second'''
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            slot = max(self.next_slot, time.monotonic())
+            self.next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a merchant after too many consecutive failures, for a cooldown period.
+    The state lives in the cache, so it is shared by every worker and kept between two poller runs.
+    """
+
+    def __init__(self, group: tuple, threshold: int, cooldown: int):
+        alias, environment = group
+        self.key = f"pretix_xpay:poll_breaker:{hashlib.sha1(alias.encode('utf-8')).hexdigest()}:{environment}"
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def allow(self) -> bool:
+        state = cache.get(self.key)
+        return state is None or state["open_until"] is None or state["open_until"] < time.time()
+
+    def record_success(self):
+        cache.delete(self.key)
+
+    def record_failure(self):
+        state = cache.get(self.key) or {"failures": 0, "open_until": None}
+        state["failures"] += 1
+        if state["failures"] >= self.threshold:
+            state["open_until"] = time.time() + self.cooldown
+        cache.set(self.key, state, self.cooldown * 2)
+
+    @property
+    def failures(self) -> int:
+        state = cache.get(self.key)
+        return state["failures"] if state else 0
+
+
+def poll_in_groups(groups: dict, poll: Callable) -> dict:
+    """
+    Polls the groups of payments concurrently, each one with its own concurrency budget, rate limit and circuit breaker.
+    At most poll_max_groups groups are polled at the same time, so the number of threads (and database connections) is bounded.
+
+    :param dict groups: the payments to poll, grouped by (alias, environment)
+    :param Callable poll: polls a single payment, returning False if XPay couldn't be reached
+    :return: the number of payments polled, failed and skipped of each group
+    :rtype: dict
+    """
+    max_groups = max(get_config("poll_max_groups", POLL_MAX_GROUPS), 1)
+    concurrency = max(get_config("poll_group_concurrency", POLL_GROUP_CONCURRENCY), 1)
+    rate = get_config("poll_group_rate", POLL_GROUP_RATE)
+    threshold = get_config("poll_breaker_threshold", POLL_BREAKER_THRESHOLD)
+    cooldown = get_config("poll_breaker_cooldown", POLL_BREAKER_COOLDOWN)
+
+    def run_group(group: tuple) -> dict:
+        limiter = RateLimiter(rate)
+        breaker = CircuitBreaker(group, threshold, cooldown)
+        stats = {"polled": 0, "failed": 0, "skipped": 0}
+        lock = threading.Lock()
+
+        def run_item(payment):
+            if not breaker.allow():
+                with lock:
+                    stats["skipped"] += 1
+                return
+            limiter.wait()
+            reached = poll(payment)
+            if reached:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            with lock:
+                stats["polled" if reached else "failed"] += 1
+
+        run_concurrently(groups[group], run_item, concurrency)
+        if stats["skipped"] > 0:
+            logger.warning(f"XPAY_poll_in_groups [{group[1]}]: {stats['skipped']} payments skipped, merchant has {breaker.failures} consecutive failures")
+        return stats
+
+    keys = list(groups.keys())
+    return dict(zip(keys, run_concurrently(keys, run_group, min(len(keys), max_groups))))
@@ -1,83 +1,236 @@
 import logging
-import pretix_xpay.xpay_api as xpay
-from datetime import timedelta
+from typing import TYPE_CHECKING
+from datetime import datetime, timedelta
 from django.http import Http404
 from django.dispatch import receiver
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from django_scopes import scopes_disabled
 from django.db import transaction
-from pretix.base.models import OrderPayment, Order, Quota
+from django.urls import resolve, reverse
+from pretix.base.models import Event, OrderPayment, Order, Quota
 from pretix.base.settings import settings_hierarkey
 from pretix.base.signals import (
     logentry_display,
     periodic_task,
+    register_data_exporters,
     register_payment_providers,
 )
-from pretix_xpay.payment import XPayPaymentProvider
-from pretix_xpay.constants import XPAY_RESULT_AUTHORIZED, XPAY_RESULT_PENDING, XPAY_RESULT_CAPTURED, XPAY_RESULT_REFUNDED, XPAY_RESULT_CANCELED
-from pretix_xpay.utils import send_refund_needed_email, get_settings_object
+from pretix.control.signals import nav_event
+from pretix_xpay import tracing
+from pretix_xpay.poller import poll_in_groups
+from pretix_xpay.constants import XPAY_RESULT_AUTHORIZED, XPAY_RESULT_PENDING, XPAY_RESULT_CAPTURED, XPAY_RESULT_REFUNDED, XPAY_RESULT_CANCELED, ALERT_ACTION_TYPE
+from pretix_xpay.utils import report_refund_needed, get_settings_object, send_alert_digests, encode_order_id, OrderStatus
+
+if TYPE_CHECKING:
+    from pretix_xpay.payment import XPayPaymentProvider
 
 logger = logging.getLogger(__name__)
 
 @receiver(register_payment_providers, dispatch_uid="payment_xpay")
 def register_payment_provider(sender, **kwargs):
+    from pretix_xpay.payment import XPayPaymentProvider
     return [XPayPaymentProvider]
 
+@receiver(register_data_exporters, dispatch_uid="xpay_exporter_transactions")
+def register_transactions_exporter(sender, **kwargs):
+    from pretix_xpay.exporters import XPayTransactionsExporter
+    return XPayTransactionsExporter
+
+@receiver(register_data_exporters, dispatch_uid="xpay_exporter_transactions_json")
+def register_transactions_json_exporter(sender, **kwargs):
+    from pretix_xpay.exporters import XPayTransactionsJSONExporter
+    return XPayTransactionsJSONExporter
+
 @receiver(signal=logentry_display, dispatch_uid="xpay_logentry_display")
 def pretixcontrol_logentry_display(sender, logentry, **kwargs):
     if not logentry.action_type.startswith("pretix_xpay.event"):
         return
+    if logentry.action_type == ALERT_ACTION_TYPE:
+        return _("XPay payment {payment} needs a manual refund (reported by {origin}).").format(
+            payment=logentry.parsed_data.get("payment", "?"), origin=logentry.parsed_data.get("origin", "?")
+        )
+    if logentry.action_type == "pretix_xpay.event.preauths.released":
+        return _("XPay preauthorizations have been released in bulk.")
     return _("XPay reported an event (Status {status}).").format(status=logentry.parsed_data.get("STATUS", "?"))
 
+@receiver(nav_event, dispatch_uid="xpay_nav_event")
+def control_nav_release_preauths(sender, request, **kwargs):
+    if not request.user.has_event_permission(request.organizer, request.event, "can_change_orders", request=request):
+        return []
+    url = resolve(request.path_info)
+    return [{
+        "label": _("XPay preauthorizations"),
+        "url": reverse("plugins:pretix_xpay:release_preauths", kwargs={
+            "organizer": request.event.organizer.slug,
+            "event": request.event.slug,
+        }),
+        "active": url.namespace == "plugins:pretix_xpay" and url.url_name == "release_preauths",
+        "icon": "credit-card",
+    }]
+
 @receiver(periodic_task, dispatch_uid="payment_xpay_periodic_poll")
 @scopes_disabled()
 def poll_pending_payments(sender, **kwargs):
-    for payment in OrderPayment.objects.filter(provider="xpay", state__in=[OrderPayment.PAYMENT_STATE_PENDING, OrderPayment.PAYMENT_STATE_CREATED]):
-        settings = get_settings_object(payment.order.event)
-        mins = int(settings.poll_pending_timeout) if settings.poll_pending_timeout else 60
+    events = {}
+    timeouts = {}
+    groups = {}
+    payments = OrderPayment.objects.filter(
+        provider="xpay",
+        state__in=[OrderPayment.PAYMENT_STATE_PENDING, OrderPayment.PAYMENT_STATE_CREATED],
+        order__status__in=[Order.STATUS_EXPIRED, Order.STATUS_PENDING],
+    ).select_related("order", "order__event", "order__event__organizer")
+    for payment in payments:
+        # Share a single event instance (and its settings) between the payments of the same event
+        event = events.setdefault(payment.order.event_id, payment.order.event)
+        payment.order.event = event
+        if event.pk not in timeouts:
+            timeouts[event.pk] = get_poll_timeout_threshold(event)
 
-        if payment.order.status != Order.STATUS_EXPIRED and payment.order.status != Order.STATUS_PENDING:
+        # Expired and timed out payments are handled by sweep_expired_payments
+        if payment.order.status == Order.STATUS_EXPIRED and payment.created < timeouts[event.pk]:
             continue
 
+        # Group by merchant, so every merchant gets its own concurrency budget, rate limit and circuit breaker
+        groups.setdefault(get_merchant_group(event), []).append(payment)
+
+    for payment_list in groups.values():
+        for payment in payment_list:
+            payment.payment_provider # Load the providers before the workers share them
+    poll_in_groups(groups, poll_payment)
+
+def poll_payment(payment: OrderPayment) -> bool:
+    '''Polls the status of a single payment and processes it. Returns False if XPay couldn't be reached'''
+    import pretix_xpay.xpay_api as xpay
+    with tracing.span("xpay.poll", encode_order_id(payment, payment.order.event), payment=payment.full_id) as span:
+        provider = payment.payment_provider
+        try:
+            data = xpay.get_order_status(payment=payment, provider=provider)
+        except Http404 as e:
+            span.set(xpay_status="not_found")
+            logger.debug(f"XPAY_poll_pending_payments [{payment.full_id}]: Payment not found on XPay yet")
+            return True
+        except Exception as e:
+            span.status = "error"
+            span.set(exception=repr(e))
+            logger.exception(f"XPAY_poll_pending_payments [{payment.full_id}]: Exception in polling transaction status: {repr(e)}")
+            return False
+
+        span.set(xpay_status=data.status)
+        try:
+            process_polled_status(payment, provider, data)
+        except Exception as e:
+            span.status = "error"
+            span.set(exception=repr(e))
+            logger.exception(f"XPAY_poll_pending_payments [{payment.full_id}]: Exception in processing transaction status: {repr(e)}")
+        return True
+
+@receiver(periodic_task, dispatch_uid="payment_xpay_periodic_sweep")
+@scopes_disabled()
+def sweep_expired_payments(sender, **kwargs):
+    """
+    Fails the payments of expired orders which reached poll_pending_timeout without XPay ever hearing of them.
+    Candidates are selected in SQL and checked through poll_in_groups, so the per merchant rate limit and circuit breaker
+    apply like in the poll loop: the ones that XPay knows are processed like there, the others are failed one by one.
+    """
+    groups = {}
+    expired = OrderPayment.objects.filter(
+        provider="xpay",
+        state__in=[OrderPayment.PAYMENT_STATE_PENDING, OrderPayment.PAYMENT_STATE_CREATED],
+        order__status=Order.STATUS_EXPIRED,
+    )
+    for event in Event.objects.filter(pk__in=expired.values("order__event_id")).select_related("organizer"):
+        candidates = expired.filter(order__event=event, created__lt=get_poll_timeout_threshold(event)).select_related("order")
+        group = get_merchant_group(event)
+        for payment in candidates:
+            payment.order.event = event
+            payment.payment_provider # Load the providers before the workers share them
+            groups.setdefault(group, []).append(payment)
+    if len(groups) > 0:
+        poll_in_groups(groups, sweep_payment)
+
+def sweep_payment(payment: OrderPayment) -> bool:
+    '''Fails a timed out payment if XPay never heard of it, otherwise processes it like the poll loop. Returns False if XPay couldn't be reached'''
+    import pretix_xpay.xpay_api as xpay
+    with tracing.span("xpay.sweep", encode_order_id(payment, payment.order.event), payment=payment.full_id) as span:
+        provider = payment.payment_provider
         try:
-            provider = payment.payment_provider
             data = xpay.get_order_status(payment=payment, provider=provider)
+        except Http404:
+            span.set(xpay_status="not_found")
+            logger.info(f"XPAY_sweep_expired_payments [{payment.full_id}]: Setting payment status to fail due to expired order and poll_pending_timeout reached")
+            try:
+                with transaction.atomic():
+                    payment.fail(log_data={"result": "poll_timeout"})
+            except Exception as e:
+                span.status = "error"
+                span.set(exception=repr(e))
+                logger.exception(f"XPAY_sweep_expired_payments [{payment.full_id}]: Exception in failing the payment: {repr(e)}")
+            return True
+        except Exception as e:
+            span.status = "error"
+            span.set(exception=repr(e))
+            logger.exception(f"XPAY_sweep_expired_payments [{payment.full_id}]: Exception in checking transaction status: {repr(e)}")
+            return False
 
-            if data.status in XPAY_RESULT_AUTHORIZED:
-                xpay.confirm_payment_and_capture_from_preauth(payment, provider, payment.order)
+        span.set(xpay_status=data.status)
+        try:
+            process_polled_status(payment, provider, data)
+        except Exception as e:
+            span.status = "error"
+            span.set(exception=repr(e))
+            logger.exception(f"XPAY_sweep_expired_payments [{payment.full_id}]: Exception in processing transaction status: {repr(e)}")
+        return True
 
-            elif data.status in XPAY_RESULT_CAPTURED:
-                try:
-                    payment.confirm()
-                    logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Payment confirmed with status {data.status}")
-                except Quota.QuotaExceededException:
-                    logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Canceling payment quota was exceeded")
-                    send_refund_needed_email(payment, origin="periodic_task.poll_pending_payments")
+def get_merchant_group(event: Event) -> tuple:
+    '''Returns the (alias, environment) pair the payments of the event are polled with'''
+    return (get_settings_object(event).alias_key or "", "test" if event.testmode else "production")
 
-            elif data.status in XPAY_RESULT_PENDING:
-                # If the payment it's still pending, weep waiting
-                if(payment.state == OrderPayment.PAYMENT_STATE_CREATED):
-                    with transaction.atomic():
-                        logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Payment is now pending")
-                        payment.state = OrderPayment.PAYMENT_STATE_PENDING
-                        payment.save(update_fields=["state"])
+def get_poll_timeout_threshold(event: Event) -> datetime:
+    '''Returns the creation time before which a pending payment of the event is considered timed out'''
+    settings = get_settings_object(event)
+    mins = int(settings.poll_pending_timeout) if settings.poll_pending_timeout else 60
+    return now() - timedelta(minutes=mins)
 
-            elif data.status in XPAY_RESULT_REFUNDED or data.status in XPAY_RESULT_CANCELED:
-                logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Canceling payment because found in a refunded or canceled status: {data.status}")
-                payment.fail(info={"error": str(_("Payment in refund or canceled state"))})
+def process_polled_status(payment: OrderPayment, provider: "XPayPaymentProvider", data: OrderStatus):
+    '''Updates a pending payment according to the status returned by XPay'''
+    import pretix_xpay.xpay_api as xpay
 
-            else:
-                logger.exception(f"XPAY_poll_pending_payments [{payment.full_id}]: Unrecognized payment status: {data.status}")
+    if data.status in XPAY_RESULT_AUTHORIZED:
+        xpay.confirm_payment_and_capture_from_preauth(payment, provider, payment.order)
 
-        except Http404 as e:
-            if payment.order.status == Order.STATUS_EXPIRED and payment.created < now() - timedelta(minutes=mins):
-                logger.exception(f"XPAY_poll_pending_payments [{payment.full_id}]: Setting payment status to fail due to expired order and poll_pending_timeout reached")
-                payment.fail(log_data={"result": "poll_timeout"})
+    elif data.status in XPAY_RESULT_CAPTURED:
+        try:
+            payment.confirm()
+            logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Payment confirmed with status {data.status}")
+        except Quota.QuotaExceededException:
+            logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Canceling payment quota was exceeded")
+            report_refund_needed(payment, origin="periodic_task.poll_pending_payments")
 
-        except Exception as e:
-            logger.exception(f"XPAY_poll_pending_payments [{payment.full_id}]: Exception in polling transaction status: {repr(e)}")
+    elif data.status in XPAY_RESULT_PENDING:
+        # If the payment it's still pending, weep waiting
+        if(payment.state == OrderPayment.PAYMENT_STATE_CREATED):
+            with transaction.atomic():
+                logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Payment is now pending")
+                payment.state = OrderPayment.PAYMENT_STATE_PENDING
+                payment.save(update_fields=["state"])
+
+    elif data.status in XPAY_RESULT_REFUNDED or data.status in XPAY_RESULT_CANCELED:
+        logger.info(f"XPAY_poll_pending_payments [{payment.full_id}]: Canceling payment because found in a refunded or canceled status: {data.status}")
+        payment.fail(info={"error": str(_("Payment in refund or canceled state"))})
+
+    else:
+        logger.exception(f"XPAY_poll_pending_payments [{payment.full_id}]: Unrecognized payment status: {data.status}")
+
+@receiver(periodic_task, dispatch_uid="payment_xpay_periodic_alert_digest")
+@scopes_disabled()
+def send_pending_alert_digests(sender, **kwargs):
+    from pretix_xpay.journal import prune_status_calls
+    send_alert_digests()
+    # Every poll journals two status entries per pending payment: don't let them pile up
+    prune_status_calls()
 
 settings_hierarkey.add_default("payment_xpay_hash", "sha1", str)
 settings_hierarkey.add_default("poll_pending_timeout", 60, int)
 settings_hierarkey.add_default("enable_test_endpoints", False, bool)
+settings_hierarkey.add_default("payment_xpay_alert_digest_interval", 15, int)
@@ -0,0 +1,37 @@
+import hashlib
+import hmac
+from typing import Iterable, Tuple
+
+
+class MacSigner:
+    """
+    Computes and verifies XPay's MACs: the hex digest of the "key=value" fields, concatenated in order, followed by the mac secret.
+    The fields are serialized once into a single buffer and hashed in a single update, starting from a copy of a
+    pre-initialized hash object. Verification runs in constant time.
+    """
+    ALGORITHMS = {
+        "sha1": hashlib.sha1,
+        "sha256": hashlib.sha256,
+    }
+
+    def __init__(self, algorithm: str, secret: str):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self._initial = self.ALGORITHMS[algorithm]()
+        self._secret = (secret or "").encode("utf-8")
+
+    def serialize(self, fields: Iterable[Tuple[str, object]]) -> bytes:
+        '''Returns the buffer being hashed'''
+        return "".join([f"{key}={value}" for key, value in fields]).encode("utf-8") + self._secret
+
+    def sign(self, fields: Iterable[Tuple[str, object]]) -> str:
+        hash_algo = self._initial.copy()
+        hash_algo.update(self.serialize(fields))
+        return hash_algo.hexdigest()
+
+    def verify(self, fields: Iterable[Tuple[str, object]], mac) -> bool:
+        '''Checks a received MAC against the fields, in constant time'''
+        if not isinstance(mac, str):
+            return False
+        return hmac.compare_digest(self.sign(fields).encode("ascii"), mac.encode("utf-8"))
@@ -0,0 +1,69 @@
+import logging
+from typing import Callable
+from pretix.base.models import Event, OrderPayment, User
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+from pretix_xpay.payment import XPayPaymentProvider
+from pretix_xpay.constants import BULK_RELEASE_WORKERS, RELEASE_FAILED
+from pretix_xpay.utils import run_concurrently, send_bulk_release_report_email
+
+logger = logging.getLogger(__name__)
+
+def get_releasable_payments(event: Event):
+    '''Returns the XPay payments of an event which may hold an authorized but not yet captured amount'''
+    return OrderPayment.objects.filter(
+        order__event=event,
+        provider="xpay",
+        state__in=[OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING],
+    ).select_related("order")
+
+def release_event_preauths(event: Event, max_workers: int = BULK_RELEASE_WORKERS, progress: Callable = None, origin: str = "-") -> dict:
+    """
+    Releases all the authorized but not captured XPay payments of an event, issuing at most max_workers calls to XPay at the same time.
+    Instead of an email for every failure, a single report is sent once everything has been processed.
+    The payments are listed once, but each one is reloaded and row locked right before being released: the ones which were
+    confirmed or settled in the meantime (eg: by the return view or the poller) are skipped.
+
+    :param Event event: the event whose payments should be released
+    :param int max_workers: the maximum number of concurrent payments being released
+    :param Callable progress: optional callback, called with (done, total) after each payment
+    :param str origin: the origin reported in the summary email
+    :return: the processed payments, grouped by RELEASE_* outcome
+    :rtype: dict
+    """
+    provider = XPayPaymentProvider(event)
+    # Load the organizer and the settings once, before the workers share them
+    event.organizer
+    provider.settings.alias_key
+    payments = list(get_releasable_payments(event))
+    for payment in payments:
+        payment.order.event = event
+    logger.info(f"XPAY_release_event_preauths [{event.slug}]: Releasing {len(payments)} payments")
+
+    outcomes = run_concurrently(payments, lambda payment: provider.release_preauth(payment, notify=False), max_workers, progress)
+
+    results = {}
+    for payment, outcome in zip(payments, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"XPAY_release_event_preauths [{payment.full_id}]: Could not release the payment: {repr(outcome)}")
+            outcome = RELEASE_FAILED
+        results.setdefault(outcome, []).append(payment)
+
+    if len(payments) > 0:
+        send_bulk_release_report_email(event, results, origin=origin)
+    return results
+
+@app.task(base=EventTask, bind=True)
+def release_preauths(self, event: Event, user: int = None) -> dict:
+    def progress(done: int, total: int):
+        if not self.request.called_directly:
+            self.update_state(state="PROGRESS", meta={"value": round(done * 100 / total, 2)})
+
+    results = release_event_preauths(event, progress=progress, origin="tasks.release_preauths")
+    counts = {outcome: len(payments) for outcome, payments in results.items()}
+    event.log_action(
+        "pretix_xpay.event.preauths.released",
+        user=User.objects.get(pk=user) if user else None,
+        data=counts,
+    )
+    return counts
@@ -0,0 +1,166 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tracing is configured in pretix's config file:
+#
+# [pretix_xpay]
+# tracing=off|log|jsonl|otel
+# tracing_file=/var/log/pretix/xpay-spans.jsonl
+#
+# "log" emits every span as a JSON line on the pretix_xpay.tracing logger, "jsonl" appends it to tracing_file and
+# "otel" forwards the spans to the OpenTelemetry tracer configured in the process (the opentelemetry-api package is needed).
+TRACING_OFF = "off"
+TRACING_LOG = "log"
+TRACING_JSONL = "jsonl"
+TRACING_OTEL = "otel"
+
+_current_span = contextvars.ContextVar("pretix_xpay_current_span", default=None)
+_sinks: list = []
+_configured = False
+_configure_lock = threading.Lock()
+_tracer = None
+
+
+class Span:
+    def __init__(self, name: str, correlation_id: Optional[str], parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.correlation_id = correlation_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.time()
+        self.duration_ms = None
+
+    def set(self, **attributes):
+        '''Adds attributes to the span, eg: once the result of the traced operation is known'''
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "correlation_id": self.correlation_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+def add_sink(sink: Callable) -> None:
+    '''Registers a callable which receives every finished span'''
+    _configure()
+    _sinks.append(sink)
+
+
+def remove_sink(sink: Callable) -> None:
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def current_correlation_id() -> Optional[str]:
+    current = _current_span.get()
+    return current.correlation_id if current else None
+
+
+@contextmanager
+def span(name: str, correlation_id: str = None, **attributes):
+    """
+    Times the wrapped block and exports it as a span.
+    Nested spans inherit the correlation id of the enclosing one, so every step of a checkout shares the same id.
+
+    :param str name: the span's name
+    :param str correlation_id: the correlation id. If None, the one of the enclosing span is used
+    """
+    _configure()
+    parent = _current_span.get()
+    if correlation_id is None and parent is not None:
+        correlation_id = parent.correlation_id
+    current = Span(name, correlation_id, parent, attributes)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        otel_span = stack.enter_context(_tracer.start_as_current_span(name)) if _tracer else None
+        try:
+            yield current
+        except BaseException as e:
+            current.status = "error"
+            current.attributes["exception"] = repr(e)
+            raise
+        finally:
+            current.duration_ms = round((time.perf_counter() - start) * 1000, 3)
+            _current_span.reset(token)
+            if otel_span is not None:
+                otel_span.set_attribute("correlation_id", correlation_id or "")
+                for key, value in current.attributes.items():
+                    otel_span.set_attribute(key, str(value))
+            _export(current)
+
+
+def _export(current: Span) -> None:
+    for sink in list(_sinks):
+        try:
+            sink(current)
+        except Exception:
+            logger.exception(f"XPAY_tracing: Could not export span {current.name}")
+
+
+def _configure() -> None:
+    global _configured
+    if _configured:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        try:
+            _configure_from_settings()
+        except Exception as e:
+            # A broken tracing setup must never break the payments: fall back to no tracing
+            logger.exception(f"XPAY_tracing: Invalid tracing configuration, tracing is disabled: {repr(e)}")
+        _configured = True
+
+
+def _configure_from_settings() -> None:
+    global _tracer
+    from django.conf import settings
+    config = getattr(settings, "CONFIG_FILE", None)
+    mode = config.get("pretix_xpay", "tracing", fallback=TRACING_OFF) if config else TRACING_OFF
+
+    if mode == TRACING_LOG:
+        span_logger = logging.getLogger("pretix_xpay.tracing.spans")
+        _sinks.append(lambda s: span_logger.info(json.dumps(s.to_dict(), default=str)))
+    elif mode == TRACING_JSONL:
+        path = config.get("pretix_xpay", "tracing_file", fallback=None)
+        if not path:
+            raise ValueError("tracing=jsonl requires the tracing_file option")
+        _sinks.append(JsonLinesSink(path))
+    elif mode == TRACING_OTEL:
+        try:
+            from opentelemetry import trace
+            _tracer = trace.get_tracer("pretix_xpay")
+        except ImportError:
+            logger.error("XPAY_tracing: tracing=otel requires the opentelemetry-api package")
+
+
+class JsonLinesSink:
+    '''Appends every span as a JSON line to a file'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, current: Span):
+        line = json.dumps(current.to_dict(), default=str)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
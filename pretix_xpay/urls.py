@@ -1,6 +1,6 @@
 from django.urls import include, path, re_path
 
-from .views import ReturnView, RedirectView, PollPendingView, ManualRefundEmailView
+from .views import ReturnView, RedirectView, PollPendingView, ManualRefundEmailView, ReleasePreauthsView
 
 event_patterns = [
     re_path(
@@ -32,3 +32,10 @@ event_patterns = [
     ),
 ]
 
+urlpatterns = [
+    path(
+        "control/event/<str:organizer>/<str:event>/xpay/release_preauths/",
+        ReleasePreauthsView.as_view(),
+        name="release_preauths",
+    ),
+]
@@ -1,56 +1,334 @@
+import csv
 import hashlib
+import io
 import logging
+import queue
+import threading
+from typing import TYPE_CHECKING, Callable, Optional
+from decimal import Decimal
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django_scopes import scopes_disabled
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
-from pretix.base.models import Order, Event, OrderPayment, OrderPosition
-from pretix.base.payment import BasePaymentProvider
+from pretix.base.models import CachedFile, Order, Event, OrderPayment, OrderPosition
+from pretix.base.services.quotas import QuotaAvailability
 from pretix.base.settings import SettingsSandbox
-from datetime import datetime
-from pretix_xpay.constants import LANGUAGE_DEFAULT, LANGUAGES_TRANSLATION, XPAY_RESULT_CANCELED
+from datetime import datetime, timedelta
+from pretix_xpay.constants import LANGUAGE_DEFAULT, LANGUAGES_TRANSLATION, XPAY_RESULT_CANCELED, SETTLED_MARKER_TIMEOUT, CURRENCY_CODES, RELEASE_NEEDS_ATTENTION
+from pretix_xpay.models import XPayAlert
+from pretix_xpay.constants import RELEASED_INFO_KEY
+from pretix_xpay.constants import ALERT_ACTION_TYPE, ALERT_ATTACHMENT_DAYS, QUOTA_AVAILABILITY_TIMEOUT
 from i18nfield.strings import LazyI18nString
-from pretix.base.services.mail import mail
+
+if TYPE_CHECKING:
+    from pretix_xpay.payment import XPayPaymentProvider
 
 logger = logging.getLogger(__name__)
 
+SETTLED_PAYMENT_STATES = (OrderPayment.PAYMENT_STATE_CONFIRMED, OrderPayment.PAYMENT_STATE_FAILED, OrderPayment.PAYMENT_STATE_CANCELED)
+
 def encode_order_id(orderPayment: OrderPayment, event: Event) -> str:
     data: str = f"{event.organizer.slug}{event.slug}{orderPayment.full_id}gabibbo"
     return hashlib.sha256(data.encode('utf-8')).hexdigest()[:18]
 
-def generate_mac(data: list, provider: BasePaymentProvider) -> str:
-    hash_algo = hashlib.new(provider.settings.hash)
-    for el in data:
-        hash_algo.update(f"{el[0]}={str(el[1])}".encode("UTF-8"))
-    hash_algo.update(provider.settings.mac_secret_pass.encode("UTF-8"))
-    return hash_algo.hexdigest()
+def generate_mac(data: list, provider: "XPayPaymentProvider") -> str:
+    return provider.signer.sign(data)
+
+def verify_mac(data: list, mac: str, provider: "XPayPaymentProvider") -> bool:
+    '''Checks a MAC received from XPay, in constant time'''
+    return provider.signer.verify(data, mac)
 
 def get_settings_object(event: Event) -> SettingsSandbox:
     return SettingsSandbox("payment", "xpay", event)
 
-def send_refund_needed_email(orderPayment: OrderPayment, origin: str = "-") -> None:
-    settings = get_settings_object(orderPayment.order.event)
+def _settled_marker_key(order_code: str, payment_pk) -> str:
+    return f"pretix_xpay:settled:{order_code}:{payment_pk}"
+
+def mark_payment_settled(payment: OrderPayment) -> None:
+    '''Stores a lightweight marker for a payment which reached a final state, so duplicate returns can skip the row locks'''
+    if payment.state in SETTLED_PAYMENT_STATES:
+        cache.set(_settled_marker_key(payment.order.code, payment.pk), payment.state, SETTLED_MARKER_TIMEOUT)
+
+def claim_payment_release(payment: OrderPayment, settle: Callable, check: Callable = None) -> bool:
+    """
+    Takes a created or pending payment out of the confirm flows before its preauthorization is released.
+    The payment is reloaded and row locked, settled with settle and flagged as released, then the lock is released:
+    the XPay calls are made afterwards, without holding it. The return view and the poller never confirm a flagged payment.
+
+    :param OrderPayment payment: the payment to claim
+    :param Callable settle: called with the locked payment to move it to its final state (eg: canceled or failed)
+    :param Callable check: optional, called with the locked payment. If it returns False the payment is not claimed
+    :return: True if the payment was claimed, False if it was confirmed or settled in the meantime
+    :rtype: bool
+    """
+    with transaction.atomic():
+        locked = OrderPayment.objects.select_for_update().get(pk=payment.pk)
+        if locked.state not in (OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING):
+            return False
+        if check is not None and not check(locked):
+            return False
+        settle(locked)
+        locked.refresh_from_db()
+        locked.info_data = {**locked.info_data, RELEASED_INFO_KEY: True}
+        locked.save(update_fields=["info"])
+    payment.refresh_from_db()
+    return True
+
+def is_payment_released(payment: OrderPayment) -> bool:
+    return bool(payment.info_data.get(RELEASED_INFO_KEY))
+
+def get_settled_marker(order_code: str, payment_pk) -> Optional[str]:
+    '''Returns the final state of a payment if it was previously marked as settled, None otherwise'''
+    return cache.get(_settled_marker_key(order_code, payment_pk))
+
+def report_refund_needed(orderPayment: OrderPayment, origin: str = "-") -> None:
+    '''
+    Queues a manual refund request for the operators. No email is sent here: the incident is queued and it will be
+    included in the next digest (see send_alert_digests), deduplicated by payment. It is also shown in the order's log.
+    '''
+    transaction_id = encode_order_id(orderPayment, orderPayment.order.event)
+    XPayAlert.objects.create(
+        event_id=orderPayment.order.event_id,
+        payment_id=orderPayment.pk,
+        payment_full_id=orderPayment.full_id,
+        transaction_id=transaction_id,
+        origin=origin,
+    )
+    orderPayment.order.log_action(ALERT_ACTION_TYPE, data={
+        "payment": orderPayment.full_id,
+        "payment_id": orderPayment.pk,
+        "transaction_id": transaction_id,
+        "origin": origin,
+    })
+    logger.warning(f"XPAY_report_refund_needed [{orderPayment.full_id}]: Manual refund needed, reported by {origin}")
+
+def send_alert_digests(event: Event = None, force: bool = False) -> None:
+    '''Sends the pending manual refund digests, for a single event or for every event with queued incidents'''
+    if event is not None:
+        _send_alert_digest(event, force)
+        return
+    event_ids = XPayAlert.objects.values_list("event_id", flat=True).distinct()
+    for event in Event.objects.filter(pk__in=list(event_ids)).select_related("organizer"):
+        try:
+            _send_alert_digest(event, force)
+        except Exception as e:
+            logger.exception(f"XPAY_send_alert_digests [{event.slug}]: Could not send the digest: {repr(e)}")
+
+def _send_alert_digest(event: Event, force: bool) -> None:
+    lock_key = f"pretix_xpay:alert_digest_lock:{event.pk}"
+    if not cache.add(lock_key, True, 300):
+        return # Another worker is already sending this digest
+    try:
+        settings = get_settings_object(event)
+        # The queue only holds the pending requests: an entry committed late is simply picked up by the next digest
+        entries = list(XPayAlert.objects.filter(event_id=event.pk).order_by("created", "id"))
+        if len(entries) == 0:
+            return
+        interval = int(settings.alert_digest_interval) if settings.alert_digest_interval else 15
+        if not force and entries[0].created > now() - timedelta(minutes=interval):
+            return # Wait for more incidents to be grouped together
+
+        # Deduplicate by payment
+        incidents = {}
+        for entry in entries:
+            incident = incidents.setdefault(entry.payment_full_id, {
+                "payment": entry.payment_full_id,
+                "transaction_id": entry.transaction_id,
+                "count": 0,
+                "first_seen": entry.created,
+                "origins": [],
+            })
+            incident["count"] += 1
+            incident["last_seen"] = entry.created
+            if entry.origin not in incident["origins"]:
+                incident["origins"].append(entry.origin)
+
+        email = settings.payment_error_email
+        if email and len(email.strip()) > 0:
+            _mail_alert_digest(event, [k.strip() for k in email.split(",")], list(incidents.values()))
+        XPayAlert.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+    finally:
+        cache.delete(lock_key)
+
+def _mail_alert_digest(event: Event, to: list, incidents: list) -> None:
+    from pretix.base.services.mail import mail
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["payment", "transaction_id", "incidents", "first_seen", "last_seen", "origins"])
+    for incident in incidents:
+        writer.writerow([
+            incident["payment"],
+            incident["transaction_id"],
+            incident["count"],
+            incident["first_seen"].isoformat(),
+            incident["last_seen"].isoformat(),
+            " ".join(incident["origins"]),
+        ])
+    cf = CachedFile.objects.create(
+        expires=now() + timedelta(days=ALERT_ATTACHMENT_DAYS),
+        date=now(),
+        filename=f"xpay-refunds-{event.slug}-{now():%Y%m%d%H%M}.csv",
+        type="text/csv",
+    )
+    cf.file.save(cf.filename, ContentFile(output.getvalue().encode("utf-8")))
+
+    subject = _("Severe errors in XPay's payment process")
+    body = LazyI18nString.from_gettext(_(
+        'Severe errors occurred while processing {count} OrderPayments of the event {event}.\n'
+        'The users have probably paid more than expected (due to a double payment or to a Quota Exceeded problem) and manual refunds are needed.\n\n'
+        'Please verify the payments and orders status and, in case, proceed with manual refunds:\n{payments}\n\n'
+        'The attached CSV file contains the same list in a machine-readable format.\n\n\n'
+        'This email is autogenerated by the XPay plugin. For more information, contact us on https://github.com/APSfurizon/pretix-xpay/'
+    ))
+    ctx = {
+        "count": len(incidents),
+        "event": event.slug,
+        "payments": "\n".join(
+            f"- {i['payment']} (transactionId {i['transaction_id']}), reported {i['count']} times by: {', '.join(i['origins'])}"
+            for i in incidents
+        ),
+    }
+    mail(to, subject, body, ctx, attach_cached_files=[cf])
+
+def get_xpay_amount(amount: Decimal, currency: str) -> int:
+    '''Converts an amount to the integer number of minor units XPay expects (eg: cents)'''
+    places = django_settings.CURRENCY_PLACES.get(currency, 2)
+    return int(amount * 10 ** places)
+
+def get_xpay_currency_code(currency: str) -> str:
+    '''Returns the numeric currency code used by the back office api'''
+    if currency not in CURRENCY_CODES:
+        raise ValueError(_('Currency %s is not supported by XPay') % currency)
+    return CURRENCY_CODES[currency]
+
+def send_bulk_release_report_email(event: Event, results: dict, origin: str = "-") -> None:
+    '''Sends a single report summarizing a bulk preauthorization release, listing the payments which need a manual check'''
+    from pretix.base.services.mail import mail
+
+    settings = get_settings_object(event)
     email = settings.payment_error_email
-    if email and len(email.strip()) > 0:
-        to = [k.strip() for k in settings.payment_error_email.split(",")]
-        subject = _("Severe error in XPay's payment process")
-        body = LazyI18nString.from_gettext(_(
-            'A severe error occurred while processing the OrderPayment {op_full_id} with transactionId {transaction_id}.\n'
-            'The user has probably paid more than expected (due to a double payment or to a Quota Exceeded problem) and a manual refund is needed.\n\n'
-            'Please verify the payment and order status and, in case, proceed with a manual refund.\n\n\n'
-            'This email is autogenerated by the XPay plugin by the "{origin}" origin. For more information, contact us on https://github.com/APSfurizon/pretix-xpay/'
-        ))
-        ctx = {
-            "op_full_id": orderPayment.full_id,
-            "transaction_id": encode_order_id(orderPayment, orderPayment.order.event),
-            "origin" : origin
-        }
-        mail(to, subject, body, ctx)
-    
+    if not email or len(email.strip()) == 0:
+        return
+    to = [k.strip() for k in email.split(",")]
+    summary = "\n".join(f"- {outcome}: {len(payments)}" for outcome, payments in results.items())
+    attention = "\n".join(
+        f"- {payment.full_id} (transactionId {encode_order_id(payment, event)}): {outcome}"
+        for outcome in RELEASE_NEEDS_ATTENTION for payment in results.get(outcome, [])
+    ) or "-"
+    subject = _("XPay's preauthorizations release report")
+    body = LazyI18nString.from_gettext(_(
+        'The release of the preauthorized XPay payments of the event {event} has been completed.\n\n'
+        'Summary:\n{summary}\n\n'
+        'The following payments need a manual verification and, in case, a manual refund:\n{attention}\n\n\n'
+        'This email is autogenerated by the XPay plugin by the "{origin}" origin. For more information, contact us on https://github.com/APSfurizon/pretix-xpay/'
+    ))
+    ctx = {
+        "event": event.slug,
+        "summary": summary,
+        "attention": attention,
+        "origin": origin
+    }
+    mail(to, subject, body, ctx)
+
+def run_concurrently(items: list, fn: Callable, max_workers: int, on_done: Callable = None) -> list:
+    """
+    Calls fn on every item using at most max_workers threads.
+    Results are returned in the same order of the items; an exception raised by fn is returned in place of its result.
+    Every worker runs with scopes disabled and closes its own database connection when done.
+
+    :param list items: the items to process
+    :param Callable fn: the function to call on each item
+    :param int max_workers: the maximum number of concurrent calls
+    :param Callable on_done: optional progress callback, called with (done, total) after each item
+    :rtype: list
+    """
+    total = len(items)
+    results = [None] * total
+    jobs = queue.Queue()
+    for index, item in enumerate(items):
+        jobs.put((index, item))
+    lock = threading.Lock()
+    done = 0
+
+    def work():
+        nonlocal done
+        while True:
+            try:
+                index, item = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = fn(item)
+            except Exception as e:
+                results[index] = e
+            if on_done:
+                with lock:
+                    done += 1
+                    on_done(done, total)
+
+    def thread_main():
+        try:
+            with scopes_disabled():
+                work()
+        finally:
+            connection.close()
+
+    if max_workers <= 1:
+        work()
+        return results
+    threads = [threading.Thread(target=thread_main, daemon=True) for i in range(min(max_workers, total))]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return results
+
+def quota_will_fail(order: Order, cached: bool = True) -> bool:
+    """
+    Cheap check of whether confirming a payment of the order would certainly raise a QuotaExceededException, so the
+    payment can be stopped (or its preauthorization released) without going through the whole confirm process.
+    Only expired orders can fail, as pending ones still hold their quota.
+
+    :param Order order: the order to check
+    :param bool cached: whether availabilities may be up to a few seconds old. Never use them when money is already held
+    :rtype: bool
+    """
+    if order.status != Order.STATUS_EXPIRED:
+        return False
+
+    needed = {}
+    quotas = {}
+    for position in order.positions.select_related("item", "variation", "subevent"):
+        for quota in position.quotas:
+            needed[quota.pk] = needed.get(quota.pk, 0) + 1
+            quotas[quota.pk] = quota
+    if len(quotas) == 0:
+        return False
+
+    keys = {pk: f"pretix_xpay:quota_availability:{pk}" for pk in quotas}
+    available = cache.get_many(list(keys.values())) if cached else {}
+    missing = [quota for pk, quota in quotas.items() if keys[pk] not in available]
+    if len(missing) > 0:
+        qa = QuotaAvailability(count_waitinglist=False, early_out=False)
+        qa.queue(*missing)
+        qa.compute()
+        computed = {keys[quota.pk]: qa.results[quota][1] for quota in missing}
+        if cached:
+            cache.set_many(computed, QUOTA_AVAILABILITY_TIMEOUT)
+        available.update(computed)
+
+    # An availability of None means unlimited
+    return any(available[keys[pk]] is not None and available[keys[pk]] < count for pk, count in needed.items())
+
 def translate_language(order: Order) -> str:
     return LANGUAGES_TRANSLATION[order.locale] if order.locale in LANGUAGES_TRANSLATION else LANGUAGE_DEFAULT
 
 def build_order_desc(order: Order) -> str:
     itemNames = []
     p: OrderPosition
-    for p in order.positions.all() : itemNames.append(get_translated_text(p.item.name, order))
+    for p in order.positions.select_related("item") : itemNames.append(get_translated_text(p.item.name, order))
     return f"[{order.event.organizer.name} / {order.event.name}] Order {order.code}: {', '.join(itemNames)}"
 
 def get_translated_text(value, order: Order) -> str:
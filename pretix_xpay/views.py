@@ -4,6 +4,7 @@ from django.contrib import messages
 from django.db import transaction
 from django.http import Http404, HttpResponse, HttpRequest
 from django.shortcuts import get_object_or_404, redirect
+from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _  # NoQA
@@ -14,9 +15,13 @@ from django.views.generic import TemplateView
 from django_scopes import scopes_disabled
 from pretix.base.models import Event, Order, OrderPayment, Quota
 from pretix.base.payment import PaymentException
+from pretix.base.views.tasks import AsyncAction
+from pretix.control.permissions import EventPermissionRequiredMixin
 from pretix.multidomain.urlreverse import eventreverse
-from pretix_xpay.utils import get_settings_object
+from pretix_xpay import tracing
+from pretix_xpay.utils import encode_order_id, get_settings_object, quota_will_fail, get_settled_marker, mark_payment_settled, is_payment_released, SETTLED_PAYMENT_STATES
 from pretix_xpay.payment import XPayPaymentProvider
+from pretix_xpay.tasks import get_releasable_payments, release_preauths
 from pretix_xpay.constants import XPAY_STATUS_SUCCESS, XPAY_STATUS_FAILS, XPAY_STATUS_PENDING, HASH_TAG
 
 PENDING_OR_CREATED_STATES = (OrderPayment.PAYMENT_STATE_PENDING, OrderPayment.PAYMENT_STATE_CREATED)
@@ -37,18 +42,38 @@ class XPayOrderView:
     def pprov(self) -> XPayPaymentProvider:
             return self.payment.payment_provider
     
-    @property
+    @cached_property
     def payment(self) -> OrderPayment:
+        # Resolved once per request: every later access reuses the same instance
         return get_object_or_404(self.order.payments, pk=self.kwargs["payment"], provider__istartswith="xpay")
 
+    def _redirect_to_order(self):
+        return redirect(
+            eventreverse(
+                self.request.event,
+                "presale:event.order",
+                kwargs={"order": self.order.code, "secret": self.order.secret},
+            )
+            + ("?paid=yes" if self.order.status == Order.STATUS_PAID else "")
+        )
+
     # On success, return gracefully, otherwise throws a PaymentException
     def process_result(self, get_params: dict, payment: OrderPayment, provider: XPayPaymentProvider):
+        with tracing.span("xpay.process_result", esito=get_params.get("esito")):
+            self._process_result(get_params, payment, provider)
+
+    def _process_result(self, get_params: dict, payment: OrderPayment, provider: XPayPaymentProvider):
+        failed = False
         with transaction.atomic():
             # Recover order payment
             payment = OrderPayment.objects.select_for_update().get(pk=payment.pk)
 
             if payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED:
                 return  # race condition
+            if is_payment_released(payment):
+                logger.info(f"XPAY_order_process_result [{payment.full_id}]: Payment was canceled and its preauthorization released")
+                messages.error(self.request, _("The payment has been canceled. You can click below to try again."))
+                return
             
             payment.info_data = {**payment.info_data, **get_params}
             payment.save(update_fields=["info"])
@@ -65,12 +90,18 @@ class XPayOrderView:
                 logger.info(f"XPAY_order_process_result [{payment.full_id}]: Payment is now failed")
                 messages.error(self.request, _("The payment has failed. You can click below to try again."))
                 payment.fail(info={"error": str(_("Payment result is in a failed status"))})
-                return
+                failed = True
             else:
                 raise PaymentException("Unrecognized state.")
 
+        if failed:
+            # Marked only once committed: a rollback must not leave a stale marker behind
+            mark_payment_settled(payment)
+            return
+
         # Fallback if payment is success
         xpay.confirm_payment_and_capture_from_preauth(payment, provider, self.order)
+        mark_payment_settled(payment)
     
 @method_decorator(csrf_exempt, name="dispatch")
 @method_decorator(xframe_options_exempt, "dispatch")
@@ -79,9 +110,25 @@ class ReturnView(XPayOrderView, View):
         return self._handle(request.GET.dict())
         
     def _handle(self, data: dict):
+        correlation_id = data.get("codTrans") or encode_order_id(self.payment, self.order.event)
+        with tracing.span("xpay.return", correlation_id, result=self.kwargs.get("result"), order=self.order.code, payment=self.kwargs["payment"]) as span:
+            response = self._process_return(data)
+            span.set(order_status=self.order.status)
+            return response
+
+    def _process_return(self, data: dict):
+        settled_state = self._get_settled_state(data)
+        if settled_state is not None:
+            # Duplicate return (browser refresh or repeated redirect) for an already settled payment: no HMAC, no row locks
+            logger.info(f"XPAY_return_handle [{self.order.code}-P-{self.kwargs['payment']}]: payment already settled with state {settled_state}.")
+            if settled_state != OrderPayment.PAYMENT_STATE_CONFIRMED:
+                messages.error(self.request, _("The payment has failed. You can click below to try again."))
+            return self._redirect_to_order()
+
         if self.kwargs.get("result") == "ko":
             logger.error(f"XPAY_return_handle [{self.payment.full_id}]: payment failed gracefully.")
             self.payment.fail(info=dict(data.items()), log_data={"result": self.kwargs.get("result"), **dict(data.items())} )
+            mark_payment_settled(self.payment)
             messages.error(self.request, _("The payment has failed. You can click below to try again."))
             return self._redirect_to_order()
         
@@ -101,38 +148,84 @@ class ReturnView(XPayOrderView, View):
             except PaymentException as e:
                 logger.error(f"XPAY_return_handle [{self.payment.full_id}]: A PaymentException occurred: {repr(e)}")
                 messages.error(self.request, _("The payment has failed. You can click below to try again. Details: %s") % repr(e))
+                self.payment.refresh_from_db(fields=["state"])
                 if self.payment.state in PENDING_OR_CREATED_STATES:
                     self.payment.fail(log_data={"exception": str(e)})
+                    mark_payment_settled(self.payment)
 
             return self._redirect_to_order()
         
         else:
             self.payment.fail(info=dict(data.items()), log_data={"result": self.kwargs.get("result"), **dict(data.items())} )
+            mark_payment_settled(self.payment)
             messages.error(self.request, _("The payment has failed. You can click below to try again."))
             logger.error(f"XPAY_return_handle [{self.payment.full_id}]: The payment has failed due to an unknown result.")
             return self._redirect_to_order()
 
-    def _redirect_to_order(self):
-        return redirect(
-            eventreverse(
-                self.request.event,
-                "presale:event.order",
-                kwargs={"order": self.order.code, "secret": self.order.secret},
-            )
-            + ("?paid=yes" if self.order.status == Order.STATUS_PAID else "")
-        )
+    def _get_settled_state(self, data: dict):
+        """
+        Returns the final state of the payment if this return can be answered without processing it again, None otherwise.
+        The cached marker is checked first; the (once resolved) payment is only read if no marker is found.
+        """
+        state = get_settled_marker(self.order.code, self.kwargs["payment"])
+        if state is None and self.payment.state in SETTLED_PAYMENT_STATES:
+            state = self.payment.state
+            mark_payment_settled(self.payment)
+        if state is None or state == OrderPayment.PAYMENT_STATE_CONFIRMED:
+            return state
+        # A successful preauth landing on a failed payment is not a duplicate: let the full process handle it
+        if self.kwargs.get("result") == "ok" and data.get("esito") in XPAY_STATUS_SUCCESS:
+            return None
+        return state
     
 @method_decorator(xframe_options_exempt, "dispatch")
 class RedirectView(XPayOrderView, TemplateView):
     template_name = "pretix_xpay/redirecting.html"
 
+    def get(self, request: HttpRequest, *args, **kwargs):
+        if self.payment.state in PENDING_OR_CREATED_STATES and quota_will_fail(self.order):
+            # Don't even start a payment which would certainly fail on return
+            logger.info(f"XPAY_redirect [{self.payment.full_id}]: Quota pre-check failed, the payment is not started.")
+            self.payment.fail(info={"error": str(_("Quota exceeded"))}, log_data={"result": "quota_precheck"})
+            messages.error(request, _("Sorry, some of the products in your order are not available anymore. Your payment has not been started."))
+            return self._redirect_to_order()
+        return super().get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx["url"] = xpay.initialize_payment_get_url(self.pprov)
-        ctx["params"] = xpay.initialize_payment_get_params(self.payment, self.pprov, kwargs["order"], kwargs["hash"], kwargs["payment"])
+        with tracing.span("xpay.redirect", encode_order_id(self.payment, self.order.event), order=self.order.code, payment=self.payment.pk):
+            ctx["url"] = xpay.initialize_payment_get_url(self.pprov)
+            ctx["params"] = xpay.initialize_payment_get_params(self.payment, self.pprov, kwargs["order"], kwargs["hash"], kwargs["payment"])
         return ctx
     
 
+class ReleasePreauthsView(EventPermissionRequiredMixin, AsyncAction, TemplateView):
+    template_name = "pretix_xpay/control_release_preauths.html"
+    permission = "can_change_orders"
+    task = release_preauths
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["count"] = get_releasable_payments(self.request.event).count()
+        return ctx
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        return self.do(self.request.event.id, user=self.request.user.pk)
+
+    def get_success_message(self, value):
+        return _("The preauthorizations have been released: {summary}. A report has been sent to the failed payments email address.").format(
+            summary=", ".join(f"{outcome} {count}" for outcome, count in value.items()) or "-"
+        )
+
+    def get_success_url(self, value):
+        return reverse("plugins:pretix_xpay:release_preauths", kwargs={
+            "organizer": self.request.organizer.slug,
+            "event": self.request.event.slug,
+        })
+
+    def get_error_url(self):
+        return self.get_success_url(None)
+
 
 
 # These are for testing purpose
@@ -140,23 +233,25 @@ class RedirectView(XPayOrderView, TemplateView):
 @method_decorator(xframe_options_exempt, "dispatch")
 class PollPendingView(View):
     def get(self, request: HttpRequest, *args, **kwargs):
-        from pretix_xpay.signals import poll_pending_payments
+        from pretix_xpay.signals import poll_pending_payments, sweep_expired_payments
         event: Event = Event.objects.get(slug=kwargs.get("event"), organizer__slug=kwargs.get("organizer"))
         if event.testmode:
             settings = get_settings_object(event)
             if settings.enable_test_endpoints:
                 logger.info(f"poll_pending_payments called.")
                 poll_pending_payments(None)
+                sweep_expired_payments(None)
                 return HttpResponse("ok", content_type="text/plain")
         return HttpResponse("nope", content_type="text/plain")
 @method_decorator(xframe_options_exempt, "dispatch")
 class ManualRefundEmailView(XPayOrderView, View):
     def get(self, request: HttpRequest, *args, **kwargs):
-        from pretix_xpay.utils import send_refund_needed_email
+        from pretix_xpay.utils import report_refund_needed, send_alert_digests
         if self.order.event.testmode:
             settings = get_settings_object(self.order.event)
             if settings.enable_test_endpoints:
                 logger.info(f"test_manual_refund_email called with order: {self.order.code}")
-                send_refund_needed_email(self.payment, origin="Testing! :3")
+                report_refund_needed(self.payment, origin="Testing! :3")
+                send_alert_digests(self.order.event, force=True)
                 return HttpResponse("ok", content_type="text/plain")
         return HttpResponse("nope", content_type="text/plain")
\ No newline at end of file
@@ -1,21 +1,29 @@
+import hashlib
 import logging
-import requests 
+from django.core.cache import cache
+from django.db import transaction
 from django.http import HttpRequest, Http404
 from django.utils.translation import gettext_lazy as _
 from pretix.base.models import OrderPayment, Order, Quota
 from pretix.base.payment import PaymentException
 from pretix.multidomain.urlreverse import build_absolute_uri
-from pretix_xpay.payment import XPayPaymentProvider
-from pretix_xpay.utils import encode_order_id, generate_mac, build_order_desc, translate_language
-from pretix_xpay.utils import OrderStatus, send_refund_needed_email
+from pretix_xpay import journal, tracing
+from pretix_xpay.utils import encode_order_id, generate_mac, verify_mac, build_order_desc, translate_language, get_xpay_amount, get_xpay_currency_code
+from pretix_xpay.utils import OrderStatus, report_refund_needed, quota_will_fail, is_payment_released, claim_payment_release
 from pretix_xpay.constants import *
 from time import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pretix_xpay.payment import XPayPaymentProvider
 
 logger = logging.getLogger(__name__)
 
-def initialize_payment_get_params(payment: OrderPayment, provider: XPayPaymentProvider, order_code: str, order_salted_hash: str, payment_pk) -> dict:
+def initialize_payment_get_params(payment: OrderPayment, provider: "XPayPaymentProvider", order_code: str, order_salted_hash: str, payment_pk) -> dict:
     """
-    Initializes the payment creation parameters
+    Initializes the payment creation parameters.
+    The signed parameters are cached per payment, so reloading the redirect page doesn't rebuild them.
+    The cached set is discarded as soon as anything it was built from (amount, currency, merchant, mac secret, language, order secret) changes.
     
     :param OrderPayment payment: The payment from which issue the order accounting
     :param XPayPaymentProvider provider: The payment provider which holds the XPay logic
@@ -24,13 +32,22 @@ def initialize_payment_get_params(payment: OrderPayment, provider: XPayPaymentPr
     :param int payment_pk: the payment's primary key
     :rtype: dict
     """
-    transaction_code = encode_order_id(payment, provider.event)
-    amount = int(payment.amount * 100)
+    currency = provider.event.currency
+    amount = get_xpay_amount(payment.amount, currency)
+    # Only a hash of the mac secret is kept, the secret itself never goes to the cache
+    secret_hash = hashlib.sha256((provider.settings.mac_secret_pass or "").encode("utf-8")).hexdigest()
+    fingerprint = [amount, currency, provider.settings.alias_key, provider.settings.hash, secret_hash, payment.order.locale, order_code, order_salted_hash]
+    cache_key = f"pretix_xpay:redirect_params:{payment.pk}"
+
+    cached = cache.get(cache_key)
+    if cached and cached["fingerprint"] == fingerprint:
+        return cached["params"]
 
-    return {
+    transaction_code = encode_order_id(payment, provider.event)
+    params = {
         "alias": provider.settings.alias_key,
         "importo": amount,
-        "divisa": "EUR",
+        "divisa": currency,
         "codTrans": transaction_code,
         "url": build_absolute_uri(
                 provider.event,
@@ -54,7 +71,7 @@ def initialize_payment_get_params(payment: OrderPayment, provider: XPayPaymentPr
             ),
         "mac": generate_mac([
                 ("codTrans", transaction_code),
-                ("divisa", "EUR"),
+                ("divisa", currency),
                 ("importo", amount)
             ], provider),
         # "mail": payment.order.email, # Disabled because someone could create an order for somebody else. If this field is specified, xpay forces this email
@@ -62,26 +79,27 @@ def initialize_payment_get_params(payment: OrderPayment, provider: XPayPaymentPr
         "descrizione": build_order_desc(payment.order),
         "TCONTAB": "D" # Preauthing first. We're gonna finalize the payment after we're sure there's enough quota and the order is marked as paid
     }
+    cache.set(cache_key, {"fingerprint": fingerprint, "params": params}, REDIRECT_PARAMS_TIMEOUT)
+    return params
 
-def initialize_payment_get_url(provider: XPayPaymentProvider) -> str:
+def initialize_payment_get_url(provider: "XPayPaymentProvider") -> str:
     return get_xpay_api_url(provider) + ENDPOINT_ORDERS_CREATE
 
-def return_page_validate_digest(request: HttpRequest, provider: XPayPaymentProvider) -> bool:
+def return_page_validate_digest(request: HttpRequest, provider: "XPayPaymentProvider") -> bool:
     """
     Validates the HMAC hash after successfully paying for the order.
     """
-    hmac = generate_mac([
+    return verify_mac([
             ("codTrans", request.GET["codTrans"]),
             ("esito", request.GET["esito"]),
             ("importo", request.GET["importo"]),
-            ("divisa", "EUR"),
+            ("divisa", provider.event.currency),
             ("data", request.GET["data"]),
             ("orario", request.GET["orario"]),
             ("codAut", request.GET["codAut"])
-        ], provider)
-    return hmac == request.GET["mac"]
+        ], request.GET.get("mac"), provider)
 
-def confirm_preauth(payment: OrderPayment, provider: XPayPaymentProvider):
+def confirm_preauth(payment: OrderPayment, provider: "XPayPaymentProvider"):
     """
     Creates the body for a POST request to issue a capture after preauthorization, launches it and analyzes the returned data.
     
@@ -92,12 +110,13 @@ def confirm_preauth(payment: OrderPayment, provider: XPayPaymentProvider):
     """
     alias_key = provider.settings.alias_key
     transaction_code = encode_order_id(payment, provider.event)
-    amount = int(payment.amount * 100)
+    amount = get_xpay_amount(payment.amount, provider.event.currency)
+    currency_code = get_xpay_currency_code(provider.event.currency)
     timestamp = int(time() * 1000)
     hmac = generate_mac([
             ("apiKey", alias_key),
             ("codiceTransazione", transaction_code),
-            ("divisa", "978"),
+            ("divisa", currency_code),
             ("importo", amount),
             ("timeStamp", timestamp)
         ], provider)
@@ -106,26 +125,26 @@ def confirm_preauth(payment: OrderPayment, provider: XPayPaymentProvider):
         "apiKey": alias_key,
         "codiceTransazione": transaction_code,
         "importo": amount,
-        "divisa": "978",
+        "divisa": currency_code,
         "timeStamp": timestamp,
         "mac": hmac
     }
     try:
-        result = post_api_call(provider, ENDPOINT_ORDERS_CONFIRM, body)
+        result = post_api_call(provider, ENDPOINT_ORDERS_CONFIRM, body, payment)
     except Exception as e:
         raise PaymentException(_("An error occurred with the XPay's servers while capturing the order. Contact the event organizer and check if your order is successfull and the correct amount of money has been trasferred from your account. Be sure to remember the transaction code #%s. Exception: %s") % (f"{payment.order.code}-{transaction_code}", repr(e)))
 
-    hmac = generate_mac([
+    response_fields = [
             ("esito", result["esito"]),
             ("idOperazione", result["idOperazione"]),
             ("timeStamp", result["timeStamp"])
-        ], provider)
+        ]
 
     if(result["esito"] == "KO"):
         logger.error(f"XPAY_confirm_preauth [{payment.full_id}]: refund request failed gracefully.")
         raise PaymentException(_('Preauth confirm request failed with error code %d: %s. Contact the event organizer and check if your order is successfull and the correct amount of money has been trasferred from your account. Be sure to remember the transaction code #%s') % (result["errore"]["codice"], result["errore"]["messaggio"], f"{payment.order.code}-{transaction_code}"))
     elif(result["esito"] == "OK"):
-        if(hmac != result["mac"]):
+        if(not verify_mac(response_fields, result.get("mac"), provider)):
             logger.error(f"XPAY_confirm_preauth [{payment.full_id}]: HMAC verification failed.")
             raise PaymentException(_('Unable to validate the preauth confirm. Contact the event organizer and check if your order is successfull and the correct amount of money has been trasferred from your account. Be sure to remember the transaction code #%s') % f"{payment.order.code}-{transaction_code}")
         pass # If the process is ok, we're done
@@ -134,23 +153,25 @@ def confirm_preauth(payment: OrderPayment, provider: XPayPaymentProvider):
         raise PaymentException(_('Unknown server response (%s) in the preauth confirm process. Contact the event organizer and check if your order is successfull and the correct amount of money has been trasferred from your account. Be sure to remember the transaction code #%s') % (result["esito"], f"{payment.order.code}-{transaction_code}"))
 
 
-def refund_preauth(payment: OrderPayment, provider: XPayPaymentProvider):
+def refund_preauth(payment: OrderPayment, provider: "XPayPaymentProvider", notify: bool = True):
     """
     Creates the body for a POST request to issue a refund, launches it and analyzes the returned data.
     
     :param OrderPayment payment: The payment from which issue a refund
     :param XPayPaymentProvider provider: The payment provider which holds the XPay logic
+    :param bool notify: whether to send the manual refund email if the refund fails
     :rtype: None
     :raises PaymentException: if the refund request returns its state to anything different than 'OK' or if the HMAC verification fails. 
     """
     alias_key = provider.settings.alias_key
     transaction_code = encode_order_id(payment, provider.event)
-    amount = int(payment.amount * 100)
+    amount = get_xpay_amount(payment.amount, provider.event.currency)
+    currency_code = get_xpay_currency_code(provider.event.currency)
     timestamp = int(time() * 1000)
     hmac = generate_mac([
             ("apiKey", alias_key),
             ("codiceTransazione", transaction_code),
-            ("divisa", "978"),
+            ("divisa", currency_code),
             ("importo", amount),
             ("timeStamp", timestamp)
         ], provider)
@@ -159,39 +180,39 @@ def refund_preauth(payment: OrderPayment, provider: XPayPaymentProvider):
         "apiKey": alias_key,
         "codiceTransazione": transaction_code,
         "importo": amount,
-        "divisa": "978",
+        "divisa": currency_code,
         "timeStamp": timestamp,
         "mac": hmac
     }
     try:
-        result = post_api_call(provider, ENDPOINT_ORDERS_CANCEL, body)
+        result = post_api_call(provider, ENDPOINT_ORDERS_CANCEL, body, payment)
     except Exception as e:
-        send_refund_needed_email(payment, "xpay.refund_preauth-expPost")
+        if notify: report_refund_needed(payment, "xpay.refund_preauth-expPost")
         logger.error(f"XPAY_refund_preauth [{payment.full_id}]: POST call failed: {repr(e)}")
         raise PaymentException(_("An error occurred with the XPay's servers while issuing a refund. Contact the event organizer to execute the refund manually. Be sure to remember the transaction code #%s. Exception: %s") % (f"{payment.order.code}-{transaction_code}", repr(e)))
 
-    hmac = generate_mac([
+    response_fields = [
             ("esito", result["esito"]),
             ("idOperazione", result["idOperazione"]),
             ("timeStamp", result["timeStamp"])
-        ], provider)
+        ]
 
     if(result["esito"] == "KO"):
         logger.error(f"XPAY_refund_preauth [{payment.full_id}]: refund request failed gracefully.")
-        send_refund_needed_email(payment, "xpay.refund_preauth-ko")
+        if notify: report_refund_needed(payment, "xpay.refund_preauth-ko")
         raise PaymentException(_('Preauth refund request failed with error code %d: %s. Contact the event organizer to execute the refund manually. Be sure to remember the transaction code #%s') % (result["errore"]["codice"], result["errore"]["messaggio"], f"{payment.order.code}-{transaction_code}"))
     elif(result["esito"] == "OK"):
-        if(hmac != result["mac"]):
+        if(not verify_mac(response_fields, result.get("mac"), provider)):
             logger.error(f"XPAY_refund_preauth [{payment.full_id}]: HMAC verification failed.")
-            send_refund_needed_email(payment, "xpay.refund_preauth-hmac")
+            if notify: report_refund_needed(payment, "xpay.refund_preauth-hmac")
             raise PaymentException(_('Unable to validate the preauth refund. Contact the event organizer to execute the refund manually. Be sure to remember the transaction code #%s') % f"{payment.order.code}-{transaction_code}")
         pass # If the process is ok, we're done
     else:
         logger.error(f'XPAY_refund_preauth [{payment.full_id}]: Unknown result \'{result["esito"]}\'.')
-        send_refund_needed_email(payment, "xpay.refund_preauth-unknown")
+        if notify: report_refund_needed(payment, "xpay.refund_preauth-unknown")
         raise PaymentException(_('Unknown server response (%s) in the preauth confirm process. Contact the event organizer to execute the refund manually. Be sure to remember the transaction code #%s') % (result["esito"], f"{payment.order.code}-{transaction_code}"))
 
-def get_order_status(payment: OrderPayment, provider: XPayPaymentProvider) -> OrderStatus:
+def get_order_status(payment: OrderPayment, provider: "XPayPaymentProvider") -> OrderStatus:
     """
     Creates a body to requests an order's status, then launches the request and analyzes its response.
     If the response status is valid, it will try parse the response to an OrderStatus object.
@@ -217,7 +238,7 @@ def get_order_status(payment: OrderPayment, provider: XPayPaymentProvider) -> Or
         "timeStamp": timestamp,
         "mac": hmac
     }
-    result = post_api_call(provider, ENDPOINT_ORDERS_STATUS, body)
+    result = post_api_call(provider, ENDPOINT_ORDERS_STATUS, body, payment)
     if(result["esito"] == "KO"):
         if result["errore"]["codice"] == 2:
             raise Http404("Order not found")
@@ -225,12 +246,12 @@ def get_order_status(payment: OrderPayment, provider: XPayPaymentProvider) -> Or
     if(result["esito"] != "OK"):
         raise ValueError(_('Invalid parameter "esito" (%s) for %s.') % (result["esito"], transaction_code))
 
-    hmac = generate_mac([
+    response_fields = [
             ("esito", result["esito"]),
             ("idOperazione", result["idOperazione"]),
             ("timeStamp", result["timeStamp"])
-        ], provider)
-    if(hmac != result["mac"]):
+        ]
+    if(not verify_mac(response_fields, result.get("mac"), provider)):
         raise ValueError(_('Unable to validate the order status for %s.') % transaction_code)
     
     try: 
@@ -240,12 +261,48 @@ def get_order_status(payment: OrderPayment, provider: XPayPaymentProvider) -> Or
         raise e
     return to_return
 
-def confirm_payment_and_capture_from_preauth(payment: OrderPayment, provider: XPayPaymentProvider, order: Order):
+def release_if_quota_exceeded(payment: OrderPayment, provider: "XPayPaymentProvider") -> bool:
+    """
+    Releases the preauthorized money of a payment whose confirmation would certainly raise a QuotaExceededException.
+    The decision is taken on the reloaded and row locked payment and order, with the quota availability computed right now:
+    a payment confirmed in the meantime is never touched, and a stale availability can't release a payment which would be accepted.
+    The payment is failed and flagged as released before the locks are released; the refund is sent afterwards, outside the transaction.
+
+    :param OrderPayment payment: the payment to check
+    :param XPayPaymentProvider provider: The payment provider which holds the XPay logic
+    :return: True if the preauthorization was released and the payment failed
+    :rtype: bool
+    :raises PaymentException: if the refund request fails. The payment stays failed and a manual refund is reported
+    """
+    def quota_exceeded(locked_payment: OrderPayment) -> bool:
+        locked_order = Order.objects.select_for_update().get(pk=locked_payment.order_id)
+        return locked_order.status == Order.STATUS_EXPIRED and quota_will_fail(locked_order, cached=False)
+
+    def fail(locked_payment: OrderPayment):
+        locked_payment.fail(info={**locked_payment.info_data, "error": str(_("Quota exceeded"))}, log_data={"result": "quota_precheck"})
+
+    if not claim_payment_release(payment, fail, quota_exceeded):
+        return False
+    logger.info(f"XPAY_release_if_quota_exceeded [{payment.full_id}]: Quota pre-check failed, releasing the preauthorization.")
+    refund_preauth(payment, provider)
+    return True
+
+def confirm_payment_and_capture_from_preauth(payment: OrderPayment, provider: "XPayPaymentProvider", order: Order):
+    if release_if_quota_exceeded(payment, provider):
+        # Confirming would certainly fail: the preauthorized money was released straight away
+        raise Quota.QuotaExceededException(_("Quota exceeded"))
+
     try:
-        if payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED: # Manual detect for race conditions for skip the double confirm/refund
-            logger.info(f'XPAY_confirm_payment_and_capture_from_preauth [{payment.full_id}]: Payment was already confirmed! Race condition detected.')
-            return
-        payment.confirm()
+        with transaction.atomic():
+            locked_payment = OrderPayment.objects.select_for_update().get(pk=payment.pk)
+            if locked_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED: # Manual detect for race conditions for skip the double confirm/refund
+                logger.info(f'XPAY_confirm_payment_and_capture_from_preauth [{payment.full_id}]: Payment was already confirmed! Race condition detected.')
+                return
+            if is_payment_released(locked_payment):
+                # Its preauthorization is being released: confirming it would leave the order paid without money
+                logger.info(f'XPAY_confirm_payment_and_capture_from_preauth [{payment.full_id}]: Payment was canceled and its preauthorization released.')
+                raise PaymentException(_("The payment was canceled and the preauthorized money has been released."))
+            payment.confirm()
         logger.info(f"XPAY_confirm_payment_and_capture_from_preauth [{payment.full_id}]: Payment confirmed!")
         order.refresh_from_db()
 
@@ -260,15 +317,26 @@ def confirm_payment_and_capture_from_preauth(payment: OrderPayment, provider: XP
 
         raise e
 
-def get_xpay_api_url(provider: XPayPaymentProvider):
+def get_xpay_api_url(provider: "XPayPaymentProvider"):
     return TEST_URL if provider.event.testmode else PROD_URL
 
-def post_api_call(provider : XPayPaymentProvider, path: str, params: dict):
-    '''Launches a POST request to XPay's servers'''
-    try:
-        r = requests.post(f"{get_xpay_api_url(provider)}{path}", json=params, timeout=31.5) #timeout to slightly more than a multiple of 3, to account for TCP retrasmission time
-        r.raise_for_status()
-        return r.json()
-    except requests.RequestException:
-        logger.exception("POST: Could not reach XPay's servers.")
-        raise PaymentException(_("Could not reach payment provider."))
\ No newline at end of file
+def post_api_call(provider: "XPayPaymentProvider", path: str, params: dict, payment: OrderPayment = None):
+    '''Launches a POST request to XPay's servers. The call is journaled before being sent and after its completion'''
+    import requests
+    call = journal.record_request(path, params, payment)
+    with tracing.span("xpay.api_call", params.get("codiceTransazione"), path=path) as span:
+        try:
+            r = requests.post(f"{get_xpay_api_url(provider)}{path}", json=params, timeout=API_CALL_TIMEOUT)
+            span.set(http_status=r.status_code)
+            r.raise_for_status()
+            result = r.json()
+        except requests.RequestException as e:
+            journal.record_error(call, repr(e))
+            logger.exception("POST: Could not reach XPay's servers.")
+            raise PaymentException(_("Could not reach payment provider."))
+        except Exception as e:
+            journal.record_error(call, repr(e))
+            raise e
+        journal.record_response(call, result)
+        span.set(esito=result.get("esito"))
+        return result
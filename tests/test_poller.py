@@ -0,0 +1,108 @@
+import pytest
+
+from pretix_xpay import poller
+from pretix_xpay.poller import CircuitBreaker, RateLimiter
+
+GROUP = ("ALIAS_WEB_00000000", "test")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(poller, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(settings):
+    settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "test_poller"}}
+    from django.core.cache import cache
+    cache.clear()
+    return cache
+
+
+def test_rate_limiter_spaces_calls(clock):
+    limiter = RateLimiter(5)
+    for _ in range(3):
+        limiter.wait()
+    assert clock.sleeps == pytest.approx([0.2, 0.2])
+
+
+def test_rate_limiter_does_not_wait_after_idle(clock):
+    limiter = RateLimiter(5)
+    limiter.wait()
+    clock.now += 10
+    limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_unlimited(clock):
+    limiter = RateLimiter(0)
+    for _ in range(10):
+        limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_circuit_breaker_opens_at_threshold(clock, cache):
+    breaker = CircuitBreaker(GROUP, threshold=3, cooldown=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.failures == 3
+
+
+def test_circuit_breaker_success_resets(clock, cache):
+    breaker = CircuitBreaker(GROUP, threshold=3, cooldown=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.failures == 1
+
+
+def test_circuit_breaker_half_open_after_cooldown(clock, cache):
+    breaker = CircuitBreaker(GROUP, threshold=3, cooldown=60)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 59
+    assert not breaker.allow()
+    clock.now += 2
+    assert breaker.allow()
+
+    # A single failed trial call opens the breaker again
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    # While a successful one closes it
+    clock.now += 61
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.failures == 0
+
+
+def test_circuit_breaker_is_per_group(clock, cache):
+    breaker = CircuitBreaker(GROUP, threshold=1, cooldown=60)
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert CircuitBreaker((GROUP[0], "production"), threshold=1, cooldown=60).allow()
+    assert CircuitBreaker(("ALIAS_WEB_11111111", "test"), threshold=1, cooldown=60).allow()
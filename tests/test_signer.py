@@ -0,0 +1,29 @@
+import hashlib
+
+import pytest
+
+from pretix_xpay.signer import MacSigner
+
+SECRET = "esempiodicalcolomac"
+FIELDS = [("codTrans", "3b1f0a9c2d7e4f5a6b"), ("divisa", "EUR"), ("importo", 12550)]
+
+
+@pytest.mark.parametrize("algorithm", ["sha1", "sha256"])
+def test_sign_matches_xpay_mac(algorithm):
+    expected = hashlib.new(algorithm, f"codTrans=3b1f0a9c2d7e4f5a6bdivisa=EURimporto=12550{SECRET}".encode()).hexdigest()
+    assert MacSigner(algorithm, SECRET).sign(FIELDS) == expected
+
+
+def test_verify():
+    signer = MacSigner("sha1", SECRET)
+    mac = signer.sign(FIELDS)
+    assert signer.verify(FIELDS, mac)
+    assert not signer.verify(FIELDS, mac.upper())
+    assert not signer.verify(FIELDS[:2], mac)
+    assert not signer.verify(FIELDS, "à" * len(mac))
+    assert not signer.verify(FIELDS, None)
+
+
+def test_unsupported_algorithm():
+    with pytest.raises(ValueError):
+        MacSigner("md5", SECRET)